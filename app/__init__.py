@@ -10,6 +10,9 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from elasticsearch import Elasticsearch
+from app.search import ElasticsearchBackend, SQLiteFTSBackend
+from app.cache import LRUCache, InvalidationListener, TwoTierCache
+from app.passwords import PasswordHasher
 import rq
 from redis import Redis
 
@@ -60,8 +63,21 @@ def create_app(config=Config):
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
     app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL']) if app.config['ELASTICSEARCH_URL'] else None
+    if app.elasticsearch:
+        app.search_backend = ElasticsearchBackend(app.elasticsearch)
+    elif app.config['SEARCH_SQLITE_PATH']:
+        app.search_backend = SQLiteFTSBackend(app.config['SEARCH_SQLITE_PATH'])
+    else:
+        app.search_backend = None
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('app', connection=app.redis)
+    app.translations = LRUCache(app.config['TRANSLATE_CACHE_SIZE'])
+    app.token_cache = LRUCache(app.config['TOKEN_CACHE_SIZE'], ttl=app.config['TOKEN_CACHE_TTL'])
+    app.token_listener = InvalidationListener('tokens:revoked', app.token_cache)
+    app.identity_cache = TwoTierCache('identity', app.config['IDENTITY_CACHE_SIZE'], ttl=app.config['IDENTITY_CACHE_TTL'])
+    app.last_seen_throttle = LRUCache(app.config['LAST_SEEN_THROTTLE_SIZE'], ttl=app.config['LAST_SEEN_RESOLUTION'])
+    app.password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                         app.config['PASSWORD_HASH_QUEUE'])
         
     from app.errors import bp as errors
     app.register_blueprint(errors)
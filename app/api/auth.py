@@ -12,6 +12,8 @@ token_auth = HTTPTokenAuth()
 def verify_password(username, password):
     user = db.session.scalar(sa.select(User).where(User.username == username))
     if user and user.check_password(password):
+        if db.session.is_modified(user):
+            db.session.commit()
         return user
     
 @token_auth.verify_token
@@ -10,6 +10,8 @@ def error_responce(status_code, message=None):
 
 @bp.errorhandler(HTTPException)
 def handle_exception(e):
+    if getattr(e, 'retry_after', None):
+        return *error_responce(e.code), {'Retry-After': str(e.retry_after)}
     return error_responce(e.code)
 
 def bad_request(message):
@@ -11,7 +11,7 @@ def get_token():
     return {'token': token}
 
 @bp.route('/tokens', methods=['DELETE'])
-@basic_auth.login_required
+@token_auth.login_required
 def revoke_token():
     token_auth.current_user().revoke_token()
     db.session.commit()
@@ -1,4 +1,4 @@
-from flask import request, url_for, abort
+from flask import request, url_for, abort, current_app
 from app.api import bp
 from app.models import User
 from app import db
@@ -7,33 +7,94 @@ from app.api.errors import bad_request
 from app.api.auth import token_auth
 
 
+def sparse_fieldset():
+    fields = request.args.get('fields')
+    include = request.args.get('include')
+    fields = [name for name in fields.split(',') if name] if fields is not None else None
+    include = [name for name in include.split(',') if name] if include is not None else None
+    if fields is not None and not set(fields) <= User.__api_fields__.keys():
+        abort(400)
+    if include is not None and not set(include) <= User.__api_embeds__.keys():
+        abort(400)
+    return fields, include
+
+def requested_ids():
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args['ids'].split(',') if id))
+    except ValueError:
+        abort(400)
+    if len(ids) > current_app.config['API_MAX_IDS']:
+        abort(400)
+    return ids
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return db.get_or_404(User, id).to_dict()
+    fields, include = sparse_fieldset()
+    user = db.get_or_404(User, id, options=User.load_options(fields, include))
+    return user.to_dict(fields=fields, include=include)
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, int)
+    if 'ids' in request.args:
+        fields, include = sparse_fieldset()
+        return User.to_lookup_dict(requested_ids(), fields=fields, include=include)
+    cursor = request.args.get('cursor')
     per_page = min(request.args.get('per_page', 10, int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users')
+    count = request.args.get('count', 0, int)
+    fields, include = sparse_fieldset()
+    return User.to_collection_dict(sa.select(User), cursor, per_page, 'api.get_users', count=count,
+                                   fields=fields, include=include)
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, int)
+    cursor = request.args.get('cursor')
     per_page = min(request.args.get('per_page', 10, int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', id=id)
+    count = request.args.get('count', 0, int)
+    fields, include = sparse_fieldset()
+    return User.to_collection_dict(user.followers.select(), cursor, per_page, 'api.get_followers', count=count,
+                                   fields=fields, include=include, id=id)
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
 def get_following(id):
     user = db.get_or_404(User, id)
-    page = request.args.get('page', 1, int)
-    per_page = request.args.get('per_page', 1, int)
-    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following', id=id)
+    cursor = request.args.get('cursor')
+    per_page = min(request.args.get('per_page', 10, int), 100)
+    count = request.args.get('count', 0, int)
+    fields, include = sparse_fieldset()
+    return User.to_collection_dict(user.following.select(), cursor, per_page, 'api.get_following', count=count,
+                                   fields=fields, include=include, id=id)
+
+def posted_ids():
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        abort(400)
+    if len(ids) > current_app.config['API_MAX_IDS']:
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+@bp.route('/users/<int:id>/following', methods=['POST'])
+@token_auth.login_required
+def follow_users(id):
+    if token_auth.current_user().id != id:
+        abort(403)
+    results = token_auth.current_user().follow_many(posted_ids())
+    db.session.commit()
+    return {'results': {str(id): status for id, status in results.items()}}
+
+@bp.route('/users/<int:id>/following', methods=['DELETE'])
+@token_auth.login_required
+def unfollow_users(id):
+    if token_auth.current_user().id != id:
+        abort(403)
+    results = token_auth.current_user().unfollow_many(posted_ids())
+    db.session.commit()
+    return {'results': {str(id): status for id, status in results.items()}}
 
 @bp.route('/users', methods=['POST'])
 def create_user():
@@ -59,11 +120,11 @@ def update_user(id):
         return abort(403)
     user = db.get_or_404(User, id)
     data = request.get_json()
-    if 'username' in data and data['username'] == user.username and \
+    if 'username' in data and data['username'] != user.username and \
     db.session.scalar(sa.select(User).where(User.username == data['username'])):
         return bad_request('please use a different username')
     
-    if 'email' in data and data['email'] == user.email and \
+    if 'email' in data and data['email'] != user.email and \
     db.session.scalar(sa.select(User).where(User.email == data['email'])):
         return bad_request('please use a different email')
     user.from_dict(data, new_user=False)
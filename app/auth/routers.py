@@ -22,6 +22,7 @@ def login():
             flash(_("Invalid username or password"))
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('main.index')
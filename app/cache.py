@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import json
+import threading
+import time
+import redis.exceptions
+from flask import current_app
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU cache with an optional per-entry TTL in seconds."""
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                del self.data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class SingleFlight(object):
+    """Run at most one call per key at a time; concurrent callers wait for and share its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result(), True
+        try:
+            result = function()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result, False
+
+
+class InvalidationListener(object):
+    """Drop keys from a local cache when any process publishes them on a Redis channel.
+
+    The subscriber runs in a daemon thread started by ``ensure``. While it is not
+    running the local cache cannot be trusted, so ``ensure`` returns False and
+    callers should skip it; the cache is cleared whenever the thread (re)starts.
+    """
+    def __init__(self, channel, cache, retry=30):
+        self.channel = channel
+        self.cache = cache
+        self.retry = retry
+        self.thread = None
+        self.last_attempt = None
+        self.lock = threading.Lock()
+
+    def ensure(self, redis_client):
+        if self.thread is not None and self.thread.is_alive():
+            return True
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return True
+            now = time.monotonic()
+            if self.last_attempt is not None and now - self.last_attempt < self.retry:
+                return False
+            self.last_attempt = now
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self.handle})
+            except redis.exceptions.RedisError:
+                return False
+            self.cache.clear()
+            self.thread = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self.stop)
+        return True
+
+    def handle(self, message):
+        self.cache.delete(message['data'].decode('utf-8'))
+
+    def stop(self, error, pubsub, thread):
+        thread.stop()
+
+
+class TwoTierCache(object):
+    """JSON values cached in a per-process LRU in front of Redis, kept coherent across processes.
+
+    ``invalidate`` deletes keys from Redis and publishes them so every process drops
+    its local copy. Hit, miss and eviction counts are added to the ``<name>:stats``
+    Redis hash at most every ``report_interval`` seconds.
+    """
+    def __init__(self, name, maxsize=10000, ttl=300, report_interval=10):
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl=ttl)
+        self.listener = InvalidationListener(f'{name}:invalidate', self.local)
+        self.redis_hits = self.misses = 0
+        self.report_interval = report_interval
+        self.reported = {}
+        self.last_report = time.monotonic()
+
+    def get(self, key):
+        local = self.listener.ensure(current_app.redis)
+        value = self.local.get(key) if local else None
+        if value is None:
+            try:
+                cached = current_app.redis.get(f'{self.name}:{key}')
+            except redis.exceptions.RedisError:
+                cached = None
+            if cached is None:
+                self.misses += 1
+            else:
+                self.redis_hits += 1
+                value = json.loads(cached)
+                if local:
+                    self.local.set(key, value)
+        self.report()
+        return value
+
+    def set(self, key, value):
+        if self.listener.ensure(current_app.redis):
+            self.local.set(key, value)
+        try:
+            current_app.redis.set(f'{self.name}:{key}', json.dumps(value), ex=self.ttl)
+        except redis.exceptions.RedisError:
+            pass
+
+    def invalidate(self, keys):
+        if not keys:
+            return
+        for key in keys:
+            self.local.delete(key)
+        try:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for key in keys:
+                pipeline.delete(f'{self.name}:{key}')
+                pipeline.publish(f'{self.name}:invalidate', key)
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error(f'Could not invalidate {self.name} cache keys')
+
+    def stats(self):
+        local = self.local.stats()
+        return {'size': local['size'], 'local_hits': local['hits'], 'redis_hits': self.redis_hits,
+                'misses': self.misses, 'evictions': local['evictions']}
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        stats = self.stats()
+        deltas = {field: value - self.reported.get(field, 0) for field, value in stats.items() if field != 'size'}
+        try:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for field, delta in deltas.items():
+                if delta:
+                    pipeline.hincrby(f'{self.name}:stats', field, delta)
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            return
+        self.reported = stats
@@ -1,6 +1,12 @@
-from flask import Blueprint
+from flask import Blueprint, current_app
 import os
 import click
+import redis.exceptions
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post, SearchableMixin
+from app.search import index_stats
+from app.translate import translation_stats
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -30,4 +36,144 @@ def init(lang):
     if os.system(
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
-    os.remove('messages.pot')
\ No newline at end of file
+    os.remove('messages.pot')
+
+@translate.command()
+@click.option('--window', type=int, help='Only posts newer than this many seconds.')
+@click.option('--limit', type=int, help='Number of posts to translate.')
+def pretranslate(window, limit):
+    """Queue translation of recent popular posts into every supported language."""
+    current_app.task_queue.enqueue('app.tasks.pretranslate_posts', window or current_app.config['PRETRANSLATE_WINDOW'],
+                                   limit or current_app.config['PRETRANSLATE_LIMIT'])
+
+@translate.command('stats')
+def translate_stats():
+    """Show translation cache hits and upstream calls."""
+    stats = translation_stats()
+    hits = stats.get('memory_hits', 0) + stats.get('redis_hits', 0) + stats.get('coalesced', 0)
+    total = hits + stats.get('upstream', 0)
+    click.echo(f"memory hits: {stats.get('memory_hits', 0)}, redis hits: {stats.get('redis_hits', 0)}, "
+               f"coalesced: {stats.get('coalesced', 0)}, upstream: {stats.get('upstream', 0)}, "
+               f"errors: {stats.get('errors', 0)}")
+    click.echo(f"hit ratio: {hits / total if total else 0:.1%}")
+
+@bp.cli.group()
+def language():
+    """Post language detection commands."""
+    pass
+
+@language.command()
+@click.option('--chunk-size', default=1000, help='Posts detected and committed per chunk.')
+@click.option('--queue', is_flag=True, help='Queue each chunk as a background job instead of detecting here.')
+def backfill(chunk_size, queue):
+    """Detect the language of posts that do not have one yet."""
+    last_id = total = 0
+    while True:
+        ids = db.session.scalars(sa.select(Post.id).where(Post.language.is_(None), Post.id > last_id)
+                                 .order_by(Post.id).limit(chunk_size)).all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        if queue:
+            current_app.task_queue.enqueue('app.tasks.detect_post_languages', ids)
+        else:
+            Post.detect_languages(ids)
+        total += len(ids)
+        click.echo(f'{total} posts')
+
+@bp.cli.group('last-seen')
+def last_seen():
+    """Buffered last_seen maintenance commands."""
+    pass
+
+@last_seen.command()
+def flush():
+    """Write buffered last_seen timestamps to the database."""
+    click.echo(f'{User.flush_last_seen()} users updated')
+
+@bp.cli.group()
+def cache():
+    """Shared cache commands."""
+    pass
+
+@cache.command('stats')
+def cache_stats():
+    """Show identity cache hits, misses and evictions across all processes."""
+    stats = {key.decode(): int(value) for key, value in current_app.redis.hgetall('identity:stats').items()}
+    lookups = sum(stats.get(field, 0) for field in ('local_hits', 'redis_hits', 'misses'))
+    hits = stats.get('local_hits', 0) + stats.get('redis_hits', 0)
+    click.echo(f"local hits: {stats.get('local_hits', 0)}, redis hits: {stats.get('redis_hits', 0)}, "
+               f"misses: {stats.get('misses', 0)}, evictions: {stats.get('evictions', 0)}")
+    click.echo(f"hit ratio: {hits / lookups if lookups else 0:.1%}")
+
+@bp.cli.group()
+def timeline():
+    """Home timeline maintenance commands."""
+    pass
+
+@timeline.command()
+@click.option('--batch-size', default=100, help='Number of users rebuilt per transaction.')
+def rebuild(batch_size):
+    """Rebuild every user's home timeline from the followers graph."""
+    last_id = rebuilt = 0
+    while True:
+        users = db.session.scalars(sa.select(User).where(User.id > last_id).order_by(User.id).limit(batch_size)).all()
+        if not users:
+            break
+        for user in users:
+            user.rebuild_timeline()
+        last_id = users[-1].id
+        rebuilt += len(users)
+        db.session.commit()
+    click.echo(f'Rebuilt the timelines of {rebuilt} users.')
+
+
+@bp.cli.group()
+def counters():
+    """User counter maintenance commands."""
+    pass
+
+@counters.command()
+@click.option('--batch-size', default=10000, help='Number of user ids updated per statement.')
+def repair(batch_size):
+    """Recompute follower, following and post counters and fix any drift."""
+    last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    repaired = 0
+    for start in range(1, last_id + 1, batch_size):
+        repaired += User.repair_counters(start, start + batch_size)
+        db.session.commit()
+    click.echo(f'Repaired counters of {repaired} users.')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+@search.command()
+def stats():
+    """Show pending and failed search index operations and result cache hits."""
+    stats = index_stats()
+    click.echo(f"pending: {stats.get('pending', 0)}, failed: {stats.get('failed', 0)}")
+    hits, misses = stats.get('cache_hits', 0), stats.get('cache_misses', 0)
+    ratio = hits / (hits + misses) if hits + misses else 0
+    click.echo(f"cache hits: {hits}, misses: {misses}, hit ratio: {ratio:.1%}")
+
+@search.command()
+@click.argument('index')
+@click.option('--chunk-size', default=1000, help='Rows fetched and sent per bulk request.')
+@click.option('--workers', default=4, help='Number of bulk requests in flight.')
+@click.option('--resume', is_flag=True, help='Continue from the last checkpoint.')
+@click.option('--new-index', is_flag=True, help='Build a new index and swap the alias when done.')
+def reindex(index, chunk_size, workers, resume, new_index):
+    """Rebuild the search index of a searchable model."""
+    models = {model.__tablename__: model for model in SearchableMixin.__subclasses__()}
+    if index not in models:
+        raise click.BadParameter(f"choose from {', '.join(models)}", param_hint='INDEX')
+    if not current_app.search_backend:
+        raise click.ClickException('no search backend is configured')
+    try:
+        indexed, failed = models[index].reindex(chunk_size=chunk_size, workers=workers, resume=resume, new_index=new_index)
+    except redis.exceptions.RedisError as error:
+        raise click.ClickException(f'--new-index needs Redis: {error}')
+    click.echo(f'Indexed {indexed} documents, {failed} failed.')
@@ -0,0 +1,30 @@
+import threading
+from langdetect import DetectorFactory
+from langdetect.detector_factory import PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+
+_factory = None
+_lock = threading.Lock()
+
+
+def detector_factory():
+    global _factory
+    if _factory is None:
+        with _lock:
+            if _factory is None:
+                factory = DetectorFactory()
+                factory.load_profile(PROFILES_DIRECTORY)
+                factory.seed = 0
+                _factory = factory
+    return _factory
+
+def detect_language(text):
+    detector = detector_factory().create()
+    detector.append(text)
+    try:
+        return detector.detect()
+    except LangDetectException:
+        return ''
+
+def detect_languages(texts):
+    return [detect_language(text) for text in texts]
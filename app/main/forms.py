@@ -37,7 +37,7 @@ class SearchForm(FlaskForm):
         if 'formdata' not in kwargs:
             kwargs['formdata'] = request.args
         if 'meta' not in kwargs:
-            kwargs['meta'] = {'crsf': False}
+            kwargs['meta'] = {'csrf': False}
         super(SearchForm, self).__init__(*args, **kwargs)
         
 class MessageForm(FlaskForm):
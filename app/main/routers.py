@@ -1,20 +1,22 @@
 from app import db
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+from flask import render_template, flash, redirect, url_for, request, g, current_app, abort, send_file
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
 from flask_login import current_user, login_required
 import sqlalchemy as sa
-from app.models import User, Post, Message, Notification
+import redis.exceptions
+from app.models import User, Post, Message
 from datetime import datetime, timezone
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
-from app.translate import translate
+from app.translate import translate, translate_posts, stored_translations
+from app.pagination import paginate
+from app.notifications import channel, event_stream
 from app.main import bp
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        if request.endpoint not in ('main.autocomplete', 'main.notifications', 'main.notification_stream'):
+            current_user.record_last_seen()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -23,34 +25,32 @@ def before_request():
 @login_required
 def index():
     form = PostForm()
-    page = request.args.get("page", 1, int)
+    cursor = request.args.get("cursor")
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language =''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        Post.queue_language_detection([post.id])
         flash(_("Your post is now live!"))
         return redirect(url_for("main.index"))
-    posts = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.index", page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Home', posts = posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    posts = current_user.timeline(cursor, current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for("main.index", cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("main.index", cursor=posts.prev_cursor) if posts.has_prev else None
+    return render_template('index.html', title='Home', posts = posts.items, form=form, next_url=next_url, prev_url=prev_url,
+                           translations=stored_translations(posts.items, g.locale))
 
 
 @bp.route('/user/<username>', methods=['GET', 'POST'])
 @login_required
 def user(username):
-    user: User = db.first_or_404(sa.select(User).where(User.username == username))
+    user: User = User.by_username(username) or abort(404)
     form = EmptyForm()
-    page = request.args.get("page", 1, int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False, page=page)
-    next_url = url_for("main.user", page=posts.next_num, username=user.username) if posts.has_next else None
-    prev_url = url_for("main.user", page=posts.prev_num, username=user.username) if posts.has_prev else None
-    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    cursor = request.args.get("cursor")
+    posts = paginate(user.posts.select(), [Post.timestamp, Post.id], cursor=cursor, per_page=current_app.config["POSTS_PER_PAGE"])
+    next_url = url_for("main.user", cursor=posts.next_cursor, username=user.username) if posts.has_next else None
+    prev_url = url_for("main.user", cursor=posts.prev_cursor, username=user.username) if posts.has_prev else None
+    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url,
+                           translations=stored_translations(posts.items, g.locale))
 
 @bp.route('/edit_profile/', methods = ['GET', 'POST'])
 @login_required
@@ -75,7 +75,7 @@ def edit_profile():
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.username == username))
+        user = User.by_username(username)
         if user is None:
             flash(_("User %(username)s not found", username=username))
             return redirect(url_for("main.index"))
@@ -93,7 +93,7 @@ def follow(username):
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.username == username))
+        user = User.by_username(username)
         if user is None:
             flash(_("User %(username)s not found", username=username))
             return redirect(url_for("main.index"))
@@ -110,12 +110,12 @@ def unfollow(username):
 @bp.route('/explore/', methods=['GET', 'POST'])
 @login_required
 def explore():
-    page = request.args.get("page", 1, int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for("main.explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.explore", page=posts.prev_num) if posts.has_prev else None
-    return render_template("index.html", posts=posts, title="Explore", next_url=next_url, prev_url=prev_url)
+    cursor = request.args.get("cursor")
+    posts = paginate(sa.select(Post), [Post.timestamp, Post.id], cursor=cursor, per_page=current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for("main.explore", cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("main.explore", cursor=posts.prev_cursor) if posts.has_prev else None
+    return render_template("index.html", posts=posts.items, title="Explore", next_url=next_url, prev_url=prev_url,
+                           translations=stored_translations(posts.items, g.locale))
 
 
 
@@ -126,27 +126,64 @@ def get_translate():
     data=request.get_json()
     return {"text": translate(data["text"], data["source_language"], data["dest_language"])}
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or len(items) > current_app.config['TRANSLATE_BATCH_MAX']:
+        abort(400)
+    try:
+        items = [(int(item['post_id']), item.get('source'), str(item['dest'])) for item in items]
+    except (TypeError, KeyError, ValueError):
+        abort(400)
+    posts = {post.id: post for post in db.session.scalars(sa.select(Post).where(Post.id.in_({item[0] for item in items})))}
+    results = {}
+    for dest in {item[2] for item in items}:
+        for post_id, text in stored_translations(posts.values(), dest).items():
+            results[(post_id, dest)] = text
+    missing = list({(post_id, posts[post_id].body, posts[post_id].language or source, dest)
+                    for post_id, source, dest in items
+                    if post_id in posts and (post_id, dest) not in results and (posts[post_id].language or source)})
+    translations = translate_posts(missing, workers=current_app.config['TRANSLATE_BATCH_WORKERS'])
+    results.update({(post_id, dest): translation for (post_id, body, source, dest), translation in zip(missing, translations)})
+    return {'translations': [{'post_id': post_id, 'dest': dest, 'text': results.get((post_id, dest))}
+                             for post_id, source, dest in items]}
+
 @bp.route('/search/', methods=["GET", "POST"])
 def search():
-    if g.search_form.validate():
+    if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, int)
-    posts, totals =Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    posts, totals = Post.search_documents(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.search', q=g.search_form.q.data, page=page+1) if totals > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.explore', q=g.search_form.q.data, page=page-1) if page > 1 else None
-    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
+    prev_url = url_for('main.search', q=g.search_form.q.data, page=page-1) if page > 1 else None
+    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url,
+                           translations=stored_translations(posts, g.locale))
+
+@bp.route('/autocomplete')
+@login_required
+def autocomplete():
+    prefix = request.args.get('q', '')
+    size = current_app.config['SUGGESTIONS_PER_TYPE']
+    users = User.suggest(prefix, size)
+    posts = Post.suggest(prefix, size)
+    return {
+        'users': [{'username': user.username, 'avatar': user.avatar(24),
+                   'url': url_for('main.user', username=user.username)} for user in users],
+        'posts': [{'id': post.id, 'body': post.body, 'author': post.author.username} for post in posts]
+    }, {'Cache-Control': f"private, max-age={current_app.config['SEARCH_SUGGEST_TTL']}"}
 
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
+    user = User.by_username(username) or abort(404)
     form = EmptyForm()
     return render_template('user_popup.html', form=form, user=user)
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = db.first_or_404(sa.select(User).where(User.username == recipient))
+    user = User.by_username(recipient) or abort(404)
     form = MessageForm()
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
@@ -167,17 +204,17 @@ def usrmsg():
 @bp.route('/messages')
 @login_required
 def messages():
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    page = request.args.get('page', 1, int)
-    msgs = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    cursor = request.args.get('cursor')
+    msgs = paginate(current_user.messages_received.select(), [Message.timestamp, Message.id], cursor=cursor,
+                    per_page=current_app.config['POSTS_PER_PAGE'])
     for msg in msgs:
         msg.check_status = True
         msg.time_seen = datetime.now(timezone.utc)
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    next_url = url_for('main.messages', page=msgs.next_num) \
+    next_url = url_for('main.messages', cursor=msgs.next_cursor) \
         if msgs.has_next else None
-    prev_url = url_for('main.messages', page=msgs.prev_num) \
+    prev_url = url_for('main.messages', cursor=msgs.prev_cursor) \
         if msgs.has_prev else None
     return render_template('message.html', messages=msgs.items, next_url=next_url, prev_url=prev_url)
 
@@ -185,15 +222,34 @@ def messages():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, float)
-    query = current_user.notifications.select().where(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
-    return [
-        {
-            'name': n.name,
-            'data': n.get_data(),
-            'timestamp': n.timestamp,
-        } for n in notifications
-    ]
+    try:
+        return current_user.notifications_since(since)
+    except redis.exceptions.RedisError:
+        abort(503)
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    try:
+        since = float(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    except ValueError:
+        since = 0.0
+    pubsub = current_app.redis.pubsub()
+    try:
+        pubsub.subscribe(channel(current_user.id))
+    except redis.exceptions.RedisError:
+        pubsub.close()
+        abort(503)
+    try:
+        backlog = current_user.notifications_since(since)
+    except redis.exceptions.RedisError:
+        pubsub.close()
+        abort(503)
+    config = current_app.config
+    stream = event_stream(pubsub, backlog, since, config['NOTIFICATION_HEARTBEAT'],
+                          config['NOTIFICATION_STREAM_DURATION'], config['NOTIFICATION_RETRY'])
+    return current_app.response_class(stream, mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @bp.route('/export_posts/')
 @login_required
@@ -202,4 +258,13 @@ def export_posts():
         flash(_('An export task is currently in progress'))
     else:
         current_user.launch_task('export_posts', _('Exporting posts...'))
+        db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
+
+@bp.route('/export_posts/download/')
+@login_required
+def download_export():
+    if not current_user.has_export():
+        abort(404)
+    return send_file(current_user.export_path(), mimetype='application/gzip',
+                     as_attachment=True, download_name='posts.ndjson.gz')
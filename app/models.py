@@ -5,37 +5,100 @@ import sqlalchemy as sa
 import sqlalchemy.orm as so
 from typing import Optional
 from datetime import datetime, timezone, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
+import hashlib
 import jwt
 from time import time
 from flask import current_app, url_for
-from app.search import add_to_index, remove_from_object, query_index
+from app.search import query_index, query_documents, suggest_documents, index_operation, delete_operation, queue_operations, rebuild_index
+from app.pagination import KeysetPage, decode_cursor, keyset, paginate
+from app.language import detect_languages
+from app.notifications import publish_notifications, store_notifications, stored_notifications, task_notifications, task_progress
 import json
 from time import time
 import rq
 import redis
 import secrets
+import heapq
+import random
+import os
+from sqlalchemy.dialects import postgresql, sqlite
+
+URL_TEMPLATE_ID = 2147483647
+
+def url_template(endpoint, **kwargs):
+    url = url_for(endpoint, id=URL_TEMPLATE_ID, **kwargs)
+    return url.replace(str(URL_TEMPLATE_ID), '{id}')
+
+def utc_isoformat(value):
+    return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+
+def avatar_url(digest, size):
+    return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
 
 class PaginateAPIMixin(object):
+    __api_fields__ = {}
+    __api_embeds__ = {}
+
+    @classmethod
+    def load_options(cls, fields=None, include=None):
+        if fields is None:
+            return []
+        columns = {'id'}
+        for name in fields:
+            columns.update(cls.__api_fields__[name])
+        for name in include or []:
+            columns.update(cls.__api_embeds__[name])
+        return [so.load_only(*[getattr(cls, column) for column in columns])]
+
+    @classmethod
+    def batch_context(cls, items, fields=None, include=None):
+        return {}
+
+    @classmethod
+    def to_dict_batch(cls, items, **kwargs):
+        context = cls.batch_context(items, kwargs.get('fields'), kwargs.get('include'))
+        return [item.to_dict(**context, **kwargs) for item in items]
+
+    @classmethod
+    def to_lookup_dict(cls, ids, fields=None, include=None):
+        query = sa.select(cls).where(cls.id.in_(ids)).options(*cls.load_options(fields, include))
+        items = db.session.scalars(query).all()
+        found = dict(zip([item.id for item in items], cls.to_dict_batch(items, fields=fields, include=include)))
+        return {
+            'items': {str(id): found.get(id) for id in ids},
+            '_meta': {
+                'requested': len(ids),
+                'found': len(found),
+                'not_found': [id for id in ids if id not in found]
+            }
+        }
+
     @classmethod
-    def to_collection_dict(cls, query, page, per_page, endpoint, **kwargs):
-        resource = db.paginate(query, per_page=per_page, page=page, error_out=False)
+    def to_collection_dict(cls, query, cursor, per_page, endpoint, count=False, fields=None, include=None, **kwargs):
+        query = query.options(*cls.load_options(fields, include))
+        resource = paginate(query, [cls.id], cursor=cursor, per_page=per_page, count=count)
+        if fields is not None:
+            kwargs['fields'] = ','.join(fields)
+        if include is not None:
+            kwargs['include'] = ','.join(include)
         data = {
-            'items': [item.to_dict() for item in resource.items],
+            'items': cls.to_dict_batch(resource.items, fields=fields, include=include),
             '_meta': {
-                'page': page,
                 'per_page': per_page,
-                'total_pages': resource.pages,
-                'total_items': resource.total
+                'next_cursor': resource.next_cursor,
+                'prev_cursor': resource.prev_cursor
             },
             '_links': {
-                'self': url_for(endpoint, page=page, per_page=per_page, **kwargs),
-                'next': url_for(endpoint, page=page+1, per_page=per_page, **kwargs) if resource.has_next else None,
-                'prev': url_for(endpoint, page=page-1, per_page=per_page, **kwargs) if resource.has_prev else None
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, cursor=resource.next_cursor, per_page=per_page, **kwargs) if resource.has_next else None,
+                'prev': url_for(endpoint, cursor=resource.prev_cursor, per_page=per_page, **kwargs) if resource.has_prev else None
             }
         }
+        if count:
+            data['_meta']['total_items'] = resource.total
+            data['_meta']['total_is_estimate'] = resource.total_is_estimate
         return data
 
 class SearchableMixin(object):
@@ -49,38 +112,114 @@ class SearchableMixin(object):
             when.append((ids[i], i))
         query = sa.select(cls).where(cls.id.in_(ids)).order_by(db.case(*when, value=cls.id))
         return db.session.scalars(query), total
-    
+
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def search_documents(cls, expression, page, per_page):
+        hits, total = query_documents(cls.__tablename__, expression, page, per_page, fields=cls.__searchable__)
+        return cls.from_search_hits(hits), total
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def suggest(cls, prefix, size):
+        return cls.from_search_hits(suggest_documents(cls.__tablename__, prefix, size, fields=cls.__searchable__))
+
+    @classmethod
+    def from_search_hits(cls, hits):
+        results = [cls.from_search_document(id, source) for id, source in hits]
+        missing = [id for (id, source), result in zip(hits, results) if result is None]
+        if missing:
+            query = sa.select(cls).where(cls.id.in_(missing)).options(*cls.search_load_options())
+            found = {obj.id: obj for obj in db.session.scalars(query)}
+            results = [found.get(id) if result is None else result for (id, source), result in zip(hits, results)]
+        return [result for result in results if result is not None]
+
+    def search_document(self):
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    @classmethod
+    def from_search_document(cls, id, source):
+        return None
+
+    @classmethod
+    def search_load_options(cls):
+        return []
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        operations = session.info.setdefault('search_operations', {})
+        for obj in list(session.new) + list(session.dirty):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                operations[(obj.__tablename__, obj.id)] = index_operation(obj.__tablename__, obj)
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_object(obj.__tablename__, obj)
-        session._changes = None
+                operations[(obj.__tablename__, obj.id)] = delete_operation(obj.__tablename__, obj)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    def after_commit(cls, session):
+        operations = session.info.pop('search_operations', {})
+        queue_operations(list(operations.values()))
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_operations', None)
+
+    @classmethod
+    def reindex(cls, chunk_size=1000, workers=4, resume=False, new_index=False):
+        def load_chunks(after_id):
+            query = (sa.select(cls).where(cls.id > after_id).order_by(cls.id).options(*cls.search_load_options())
+                     .execution_options(yield_per=chunk_size))
+            return db.session.scalars(query).partitions()
+        return rebuild_index(cls.__tablename__, load_chunks, workers=workers, resume=resume, new_index=new_index,
+                             fields=cls.__searchable__)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 followers = sa.Table('followers', 
                      db.metadata,
                      sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
-                     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True))
+                     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+                     sa.Index('ix_followers_followed_id', 'followed_id'))
+
+timeline = sa.Table('timeline',
+                    db.metadata,
+                    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+                    sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'), primary_key=True),
+                    sa.Column('author_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+                    sa.Column('timestamp', sa.DateTime, nullable=False),
+                    sa.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp'))
+
+def insert_ignore(table):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return sa.insert(table).prefix_with('IGNORE')
+
+def timeline_cutoff(user_id):
+    """Timestamp of the first row beyond TIMELINE_LENGTH in a user's timeline, or NULL if it is not full.
+
+    The cutoff is found on the (user_id, timestamp) index alone; rows at or before it
+    are stale, including those sharing its timestamp.
+    """
+    newest = timeline.alias()
+    return (sa.select(newest.c.timestamp).where(newest.c.user_id == user_id)
+            .order_by(newest.c.timestamp.desc())
+            .offset(current_app.config['TIMELINE_LENGTH']).limit(1).scalar_subquery())
+
+def trim_timelines(connection, user_ids):
+    """Drop the stale rows from the timeline of every user id selected by ``user_ids``."""
+    recipients = user_ids.subquery()
+    cutoffs = sa.select(recipients.c[0].label('user_id'), timeline_cutoff(recipients.c[0]).label('cutoff')).subquery()
+    rows = [{'user': user_id, 'cutoff': timestamp} for user_id, timestamp in
+            connection.execute(sa.select(cutoffs).where(cutoffs.c.cutoff.is_not(None)))]
+    if rows:
+        connection.execute(timeline.delete().where(timeline.c.user_id == sa.bindparam('user'),
+                                                   timeline.c.timestamp <= sa.bindparam('cutoff')), rows)
+
+def is_pulled_author(author_id):
+    author = so.aliased(User)
+    followers_count = sa.select(author.followers_total).where(author.id == author_id).scalar_subquery()
+    return followers_count >= current_app.config['TIMELINE_PULL_THRESHOLD']
 
 class User(PaginateAPIMixin, UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -92,6 +231,9 @@ class User(PaginateAPIMixin, UserMixin, db.Model):
     last_message_read_time: so.Mapped[Optional[datetime]]
     token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
     token_expiration: so.Mapped[Optional[datetime]] 
+    followers_total: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    following_total: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    posts_total: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
 
     notifications: so.WriteOnlyMapped['Notification'] = so.relationship(back_populates='user')
     messages_sent: so.WriteOnlyMapped['Message'] = so.relationship(foreign_keys='Message.sender_id', back_populates='author')
@@ -110,38 +252,70 @@ class User(PaginateAPIMixin, UserMixin, db.Model):
                 secondaryjoin=(followers.c.follower_id == id),
                 back_populates='following')
 
+    __api_fields__ = {
+        'id': ['id'],
+        'username': ['username'],
+        'last_seen': ['last_seen'],
+        'about_me': ['about_me'],
+        'post_count': ['posts_total'],
+        'following_count': ['following_total'],
+        'followers_count': ['followers_total']
+    }
+    __api_embeds__ = {'links': ['email']}
+    __identity_fields__ = ['id', 'username', 'email', 'about_me']
+
     def __repr__(self):
         return f"<User {self.username}>"
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash or not current_app.password_hasher.verify(self.password_hash, password):
+            return False
+        if current_app.password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
+    @staticmethod
+    def suggest(prefix, size):
+        prefix = prefix.strip()
+        if not prefix:
+            return []
+        query = (sa.select(User).where(User.username >= prefix, User.username < prefix + '\U0010ffff')
+                 .order_by(User.username).limit(size).options(so.load_only(User.username, User.email)))
+        return db.session.scalars(query).all()
+
+    def avatar_hash(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
+        return avatar_url(self.avatar_hash(), size)
     
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            db.session.execute(sa.update(User).where(User.id == self.id).values(following_total=User.following_total + 1))
+            db.session.execute(sa.update(User).where(User.id == user.id).values(followers_total=User.followers_total + 1))
+            self.backfill_timeline([user.id])
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            db.session.execute(sa.update(User).where(User.id == self.id).values(following_total=User.following_total - 1))
+            db.session.execute(sa.update(User).where(User.id == user.id).values(followers_total=User.followers_total - 1))
+            db.session.execute(timeline.delete().where(timeline.c.user_id == self.id, timeline.c.author_id == user.id))
+            User.push_demoted_authors([user.id])
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
     
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.followers_total or 0
     
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.following_total or 0
     
     def following_posts(self):
         Author = so.aliased(User)
@@ -152,6 +326,125 @@ class User(PaginateAPIMixin, UserMixin, db.Model):
             .group_by(Post)
             .order_by(Post.timestamp.desc())
         )
+
+    def timeline_posts(self):
+        cutoff = timeline_cutoff(self.id)
+        return (
+            sa.select(Post).join(timeline, timeline.c.post_id == Post.id)
+            .where(timeline.c.user_id == self.id, sa.or_(cutoff.is_(None), timeline.c.timestamp > cutoff))
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        )
+
+    def pulled_authors(self):
+        query = self.following.select().where(User.followers_total >= current_app.config['TIMELINE_PULL_THRESHOLD'])
+        return db.session.scalars(query).all()
+
+    def timeline(self, cursor, per_page):
+        direction, values = decode_cursor(cursor)
+        sources = [(self.timeline_posts(), [timeline.c.timestamp, timeline.c.post_id])]
+        for author in self.pulled_authors():
+            sources.append((author.posts.select(), [Post.timestamp, Post.id]))
+        rows = []
+        for query, keys in sources:
+            query = keyset(query, keys, direction, values).add_columns(*keys).limit(per_page + 1)
+            rows.append([tuple(row) for row in db.session.execute(query)])
+        merged = []
+        seen = set()
+        for row in heapq.merge(*rows, key=lambda row: row[1:], reverse=direction != 'prev'):
+            if row[0].id not in seen:
+                seen.add(row[0].id)
+                merged.append(row)
+        return KeysetPage(merged[:per_page + 1], per_page, direction)
+
+    def backfill_timeline(self, author_ids):
+        rank = sa.func.row_number().over(partition_by=Post.user_id, order_by=Post.timestamp.desc())
+        recent = (sa.select(Post.id, Post.user_id, Post.timestamp, rank.label('rank'))
+                  .where(Post.user_id.in_(author_ids), Post.user_id != self.id, sa.not_(is_pulled_author(Post.user_id)))
+                  .subquery())
+        db.session.execute(insert_ignore(timeline).from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(sa.literal(self.id), recent.c.id, recent.c.user_id, recent.c.timestamp)
+            .where(recent.c.rank <= current_app.config['TIMELINE_LENGTH'])))
+        self.trim_timeline()
+
+    def follow_many(self, ids):
+        query = (
+            sa.select(User.id, followers.c.follower_id).where(User.id.in_(ids))
+            .outerjoin(followers, sa.and_(followers.c.followed_id == User.id, followers.c.follower_id == self.id))
+        )
+        results = {id: 'not_found' for id in ids}
+        targets = []
+        for id, follower_id in db.session.execute(query):
+            if id == self.id:
+                results[id] = 'self'
+            elif follower_id is not None:
+                results[id] = 'already_following'
+            else:
+                targets.append(id)
+        if targets:
+            query = insert_ignore(followers).values([{'follower_id': self.id, 'followed_id': id} for id in targets])
+            results.update({id: 'already_following' for id in targets})
+            if db.session.get_bind().dialect.insert_returning:
+                targets = db.session.scalars(query.returning(followers.c.followed_id)).all()
+            else:
+                targets = [id for id in targets if db.session.execute(
+                    insert_ignore(followers).values(follower_id=self.id, followed_id=id)).rowcount]
+            results.update({id: 'followed' for id in targets})
+            db.session.execute(sa.update(User).where(User.id == self.id).values(following_total=User.following_total + len(targets)))
+            db.session.execute(sa.update(User).where(User.id.in_(targets)).values(followers_total=User.followers_total + 1))
+            self.backfill_timeline(targets)
+        return results
+
+    def unfollow_many(self, ids):
+        results = {id: 'not_found' for id in ids}
+        results.update({id: 'self' if id == self.id else 'not_following'
+                        for id in db.session.scalars(sa.select(User.id).where(User.id.in_(ids)))})
+        query = followers.delete().where(followers.c.follower_id == self.id, followers.c.followed_id.in_(ids))
+        if db.session.get_bind().dialect.delete_returning:
+            targets = db.session.scalars(query.returning(followers.c.followed_id)).all()
+        else:
+            candidates = db.session.scalars(sa.select(followers.c.followed_id).where(query.whereclause)).all()
+            targets = [id for id in candidates if db.session.execute(followers.delete().where(
+                followers.c.follower_id == self.id, followers.c.followed_id == id)).rowcount]
+        if targets:
+            results.update({id: 'unfollowed' for id in targets})
+            db.session.execute(sa.update(User).where(User.id == self.id).values(following_total=User.following_total - len(targets)))
+            db.session.execute(sa.update(User).where(User.id.in_(targets)).values(followers_total=User.followers_total - 1))
+            db.session.execute(timeline.delete().where(timeline.c.user_id == self.id, timeline.c.author_id.in_(targets)))
+            User.push_demoted_authors(targets)
+        return results
+
+    @staticmethod
+    def push_demoted_authors(author_ids):
+        """Fan out the recent posts of authors who just dropped below TIMELINE_PULL_THRESHOLD.
+
+        Their posts were pulled at read time until now, so their followers' stored
+        timelines hold none of them.
+        """
+        threshold = current_app.config['TIMELINE_PULL_THRESHOLD']
+        demoted = db.session.scalars(sa.select(User.id).where(User.id.in_(author_ids), User.followers_total == threshold - 1)).all()
+        if not demoted:
+            return
+        rank = sa.func.row_number().over(partition_by=Post.user_id, order_by=Post.timestamp.desc())
+        recent = (sa.select(Post.id, Post.user_id, Post.timestamp, rank.label('rank'))
+                  .where(Post.user_id.in_(demoted)).subquery())
+        db.session.execute(insert_ignore(timeline).from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(followers.c.follower_id, recent.c.id, recent.c.user_id, recent.c.timestamp)
+            .join(followers, followers.c.followed_id == recent.c.user_id)
+            .where(recent.c.rank <= current_app.config['TIMELINE_LENGTH'])))
+        trim_timelines(db.session.connection(), sa.select(followers.c.follower_id).where(followers.c.followed_id.in_(demoted)))
+
+    def rebuild_timeline(self):
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        query = self.following_posts().where(sa.or_(Post.user_id == self.id, sa.not_(is_pulled_author(Post.user_id))))
+        posts = query.limit(current_app.config['TIMELINE_LENGTH']).subquery()
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(sa.literal(self.id), posts.c.id, posts.c.user_id, posts.c.timestamp)))
+
+    def trim_timeline(self):
+        trim_timelines(db.session.connection(), sa.select(sa.literal(self.id)))
     
     def get_password_token(self, expires_in=600):
         return jwt.encode({"reset_password":self.id, 'exp': time()+expires_in}, current_app.config['SECRET_KEY'], algorithm='HS256')
@@ -169,49 +462,223 @@ class User(PaginateAPIMixin, UserMixin, db.Model):
         return db.session.get(User, id)
     
     def add_notification(self, name,  data):
-        db.session.execute(self.notifications.delete().where(Notification.name == name))
-        notification = Notification(user=self, name=name, payload_json=json.dumps(data))
-        db.session.add(notification)
+        notification = Notification(user_id=self.id, name=name, payload_json=json.dumps(data), timestamp=time())
+        if current_app.config['NOTIFICATION_STORE'] != 'redis':
+            db.session.execute(self.notifications.delete().where(Notification.name == name))
+            db.session.add(notification)
+        db.session.info.setdefault('notifications', []).append(
+            {'user_id': self.id, 'name': name, 'data': data, 'timestamp': notification.timestamp})
         return notification
+
+    def notifications_since(self, since):
+        if current_app.config['NOTIFICATION_STORE'] == 'redis':
+            notifications = stored_notifications(self.id, since)
+        else:
+            query = self.notifications.select().where(Notification.timestamp > since).order_by(Notification.timestamp.asc())
+            notifications = [notification.to_dict() for notification in db.session.scalars(query)]
+        progress = [{key: notification[key] for key in ('name', 'data', 'timestamp')}
+                    for notification in task_notifications(self.id) if notification['timestamp'] > since]
+        return sorted(notifications + progress, key=lambda notification: notification['timestamp'])
     
     @login.user_loader
     def load_user(id):
-        return db.session.get(User, int(id))
+        return User.cached(int(id))
+
+    def identity_fields(self):
+        return {field: getattr(self, field) for field in User.__identity_fields__}
+
+    @staticmethod
+    def from_identity(fields):
+        existing = db.session.identity_map.get(sa.inspect(User).identity_key_from_primary_key((fields['id'],)))
+        if existing is not None:
+            return existing
+        user = User(**fields)
+        so.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def cached(id):
+        fields = current_app.identity_cache.get(f'id:{id}')
+        if fields is not None:
+            return User.from_identity(fields)
+        user = db.session.get(User, id)
+        if user is not None:
+            current_app.identity_cache.set(f'id:{id}', user.identity_fields())
+        return user
+
+    @staticmethod
+    def by_username(username):
+        id = current_app.identity_cache.get(f'username:{username}')
+        if id is not None:
+            return User.cached(id)
+        user = db.session.scalar(sa.select(User).where(User.username == username))
+        if user is not None:
+            current_app.identity_cache.set(f'username:{username}', user.id)
+            current_app.identity_cache.set(f'id:{user.id}', user.identity_fields())
+        return user
+
+    @staticmethod
+    def after_flush_identity(session, flush_context):
+        keys = session.info.setdefault('identity_invalidations', set())
+        for user in list(session.dirty) + list(session.deleted):
+            if not isinstance(user, User):
+                continue
+            state = sa.inspect(user)
+            if user in session.deleted or any(state.attrs[field].history.has_changes() for field in User.__identity_fields__):
+                keys.add(f'id:{user.id}')
+                keys.update(f'username:{username}' for username in
+                            list(state.attrs.username.history.deleted) + [user.username])
+
+    @staticmethod
+    def after_commit_identity(session):
+        current_app.identity_cache.invalidate(list(session.info.pop('identity_invalidations', [])))
+
+    @staticmethod
+    def after_rollback_identity(session):
+        session.info.pop('identity_invalidations', None)
     
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f"app.tasks.{name}", self.id,  *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
+        rq_job = current_app.task_queue.enqueue(f"app.tasks.{name}", self.id,  *args, meta={'user_id': self.id}, **kwargs)
+        task = Task(id=rq_job.id, name=name, description=description, user=self)
         db.session.add(task)
         return task
 
     def get_tasks_in_progress(self):
-        query = self.tasks.select().where(Task.complete == True)
+        query = self.tasks.select().where(Task.complete == False)
         return db.session.scalars(query)
     
     def get_task_in_progress(self, name):
-        query = self.tasks.select().where(Task.name == name, Task.complete == True)
+        query = self.tasks.select().where(Task.name == name, Task.complete == False)
         return db.session.scalar(query)
+
+    def tasks_progress(self):
+        tasks = self.get_tasks_in_progress().all()
+        progress = task_progress(self.id, [task.id for task in tasks])
+        return [(task, progress.get(task.id, 0)) for task in tasks]
     
     def posts_count(self):
-        query = sa.select(sa.func.count()).select_from(self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.posts_total or 0
+
+    def export_path(self):
+        return os.path.join(current_app.config['EXPORT_DIR'], f'{self.id}.ndjson.gz')
+
+    def has_export(self):
+        return os.path.exists(self.export_path())
+
+    @staticmethod
+    def repair_counters(start, stop):
+        followers_count = sa.select(sa.func.count()).where(followers.c.followed_id == User.id).scalar_subquery()
+        following_count = sa.select(sa.func.count()).where(followers.c.follower_id == User.id).scalar_subquery()
+        posts_count = sa.select(sa.func.count()).where(Post.user_id == User.id).scalar_subquery()
+        query = (
+            sa.update(User).where(User.id >= start, User.id < stop)
+            .where(sa.or_(User.followers_total != followers_count, User.following_total != following_count,
+                          User.posts_total != posts_count))
+            .values(followers_total=followers_count, following_total=following_count, posts_total=posts_count)
+        )
+        return db.session.execute(query, execution_options={'synchronize_session': False}).rowcount
     
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.replace(tzinfo=timezone.utc).isoformat() if self.last_seen else None,
-            'about_me': self.about_me,
-            'post_count': self.posts_count(),
-            'following_count': self.following_count(),
-            'followers_count': self.followers_count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'following': url_for('api.get_following', id=self.id),
-                'avatar': self.avatar(128)
-            } 
+    @staticmethod
+    def url_templates():
+        return {
+            'self': url_template('api.get_user'),
+            'followers': url_template('api.get_followers'),
+            'following': url_template('api.get_following')
+        }
+
+    @classmethod
+    def batch_context(cls, items, fields=None, include=None):
+        if include is None:
+            include = cls.__api_embeds__ if fields is None else []
+        context = {}
+        if 'links' in include:
+            context['urls'] = User.url_templates()
+        if fields is None or 'last_seen' in fields:
+            context['seen'] = User.buffered_last_seen([item.id for item in items])
+        return context
+
+    def record_last_seen(self):
+        if current_app.last_seen_throttle.get(self.id):
+            return
+        current_app.last_seen_throttle.set(self.id, True)
+        try:
+            current_app.redis.hset('last_seen', self.id, time())
+            interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+            if current_app.redis.set('last_seen:flush', 1, nx=True, ex=interval):
+                current_app.task_queue.enqueue_in(timedelta(seconds=interval), 'app.tasks.flush_last_seen')
+        except redis.exceptions.RedisError:
+            self.last_seen = datetime.now(timezone.utc)
+            db.session.commit()
+
+    @staticmethod
+    def buffered_last_seen(ids):
+        if not ids:
+            return {}
+        try:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            pipeline.hmget('last_seen', ids)
+            pipeline.hmget('last_seen:flushing', ids)
+            buffered, flushing = pipeline.execute()
+        except redis.exceptions.RedisError:
+            return {}
+        seen = {}
+        for id, *values in zip(ids, buffered, flushing):
+            values = [float(value) for value in values if value is not None]
+            if values:
+                seen[id] = datetime.fromtimestamp(max(values), timezone.utc).replace(tzinfo=None)
+        return seen
+
+    @staticmethod
+    def flush_last_seen():
+        try:
+            if not current_app.redis.exists('last_seen:flushing'):
+                current_app.redis.rename('last_seen', 'last_seen:flushing')
+        except redis.exceptions.ResponseError:
+            return 0
+        values = current_app.redis.hgetall('last_seen:flushing')
+        if values:
+            table = User.__table__
+            db.session.execute(
+                table.update()
+                .where(table.c.id == sa.bindparam('user_id'),
+                       sa.or_(table.c.last_seen.is_(None), table.c.last_seen < sa.bindparam('seen')))
+                .values(last_seen=sa.bindparam('seen')),
+                [{'user_id': int(id), 'seen': datetime.fromtimestamp(float(value), timezone.utc).replace(tzinfo=None)}
+                 for id, value in values.items()])
+            db.session.commit()
+        current_app.redis.delete('last_seen:flushing')
+        return len(values)
+
+    def seen_at(self, seen=None):
+        if seen is None:
+            seen = User.buffered_last_seen([self.id])
+        values = [value for value in (self.last_seen and self.last_seen.replace(tzinfo=None), seen.get(self.id)) if value]
+        return max(values) if values else None
+
+    def to_dict(self, include_email=False, urls=None, fields=None, include=None, seen=None):
+        if include is None:
+            include = self.__api_embeds__ if fields is None else []
+        if fields is None:
+            fields = self.__api_fields__
+        values = {
+            'id': lambda: self.id,
+            'username': lambda: self.username,
+            'last_seen': lambda: utc_isoformat(self.seen_at(seen)),
+            'about_me': lambda: self.about_me,
+            'post_count': self.posts_count,
+            'following_count': self.following_count,
+            'followers_count': self.followers_count
         }
+        data = {name: values[name]() for name in self.__api_fields__ if name in fields}
+        if 'links' in include:
+            if urls is None:
+                urls = User.url_templates()
+            data['_links'] = {
+                'self': urls['self'].format(id=self.id),
+                'followers': urls['followers'].format(id=self.id),
+                'following': urls['following'].format(id=self.id),
+                'avatar': self.avatar(128)
+            }
         if include_email:
             data['email'] = self.email
 
@@ -228,23 +695,92 @@ class User(PaginateAPIMixin, UserMixin, db.Model):
         now = datetime.now(timezone.utc)
         if self.token and self.token_expiration.replace(tzinfo=timezone.utc) > now + timedelta(seconds=60):
             return self.token
+        tokens = db.session.info.setdefault('tokens', [])
+        if self.token:
+            tokens.append((self.token, self.id, None))
         self.token = secrets.token_hex(16)
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
+        tokens.append((self.token, self.id, self.token_expiration.timestamp()))
         return self.token
     
     def revoke_token(self):
         self.token_expiration = datetime.now(timezone.utc) - timedelta(seconds=1)
+        if self.token:
+            db.session.info.setdefault('tokens', []).append((self.token, self.id, None))
+
+    @staticmethod
+    def token_key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cache_token(key, user_id, expiry):
+        ttl = min(current_app.config['TOKEN_CACHE_TTL'], expiry - time())
+        if ttl > 0:
+            current_app.token_cache.set(key, (user_id, expiry), ttl=ttl)
+
+    @staticmethod
+    def after_commit_tokens(session):
+        updates = session.info.pop('tokens', [])
+        if not updates:
+            return
+        try:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for token, user_id, expiry in updates:
+                key = User.token_key(token)
+                if expiry is None:
+                    current_app.token_cache.delete(key)
+                    pipeline.set(f'token:{key}', 'revoked', ex=current_app.config['TOKEN_CACHE_TTL'])
+                    pipeline.publish('tokens:revoked', key)
+                else:
+                    User.cache_token(key, user_id, expiry)
+                    pipeline.set(f'token:{key}', f'{user_id}:{expiry}', exat=int(expiry))
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Could not update the token cache')
+
+    @staticmethod
+    def after_rollback_tokens(session):
+        session.info.pop('tokens', None)
+
 
     @staticmethod
     def check_token(token):
+        key = User.token_key(token)
+        local = current_app.token_listener.ensure(current_app.redis)
+        cached = current_app.token_cache.get(key) if local else None
+        if cached is None:
+            try:
+                value = current_app.redis.get(f'token:{key}')
+            except redis.exceptions.RedisError:
+                value = None
+            if value == b'revoked':
+                return None
+            if value is not None:
+                user_id, expiry = value.decode('utf-8').split(':')
+                cached = (int(user_id), float(expiry))
+                if local:
+                    User.cache_token(key, *cached)
+        if cached is not None:
+            user_id, expiry = cached
+            return User.from_identity({'id': user_id}) if expiry > time() else None
         user = db.session.scalar(sa.select(User).where(User.token == token))
         if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
             return None
+        expiry = user.token_expiration.replace(tzinfo=timezone.utc).timestamp()
+        try:
+            cached = current_app.redis.set(f'token:{key}', f'{user.id}:{expiry}', exat=int(expiry), nx=True)
+        except redis.exceptions.RedisError:
+            cached = False
+        if local and cached:
+            User.cache_token(key, user.id, expiry)
         return user
+db.event.listen(db.session, 'after_commit', User.after_commit_tokens)
+db.event.listen(db.session, 'after_rollback', User.after_rollback_tokens)
+db.event.listen(db.session, 'after_flush', User.after_flush_identity)
+db.event.listen(db.session, 'after_commit', User.after_commit_identity)
+db.event.listen(db.session, 'after_rollback', User.after_rollback_identity)
 
-        
-    
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -255,9 +791,133 @@ class Post(SearchableMixin, db.Model):
     
     author: so.Mapped[User] = so.relationship(back_populates='posts')
 
+    __table_args__ = (sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
+
     def __repr__(self):
         return f"<Post {self.body}>"
-    
+
+    def search_document(self):
+        author = self.author if self.author is not None else db.session.get(User, self.user_id)
+        return {
+            'body': self.body,
+            'timestamp': self.timestamp.replace(tzinfo=None).isoformat(),
+            'language': self.language,
+            'author_username': author.username,
+            'author_avatar': author.avatar_hash()
+        }
+
+    @classmethod
+    def from_search_document(cls, id, source):
+        if any(field not in source for field in ('body', 'timestamp', 'author_username', 'author_avatar')):
+            return None
+        author = SearchAuthor(source['author_username'], source['author_avatar'])
+        return SearchPost(id, source['body'], datetime.fromisoformat(source['timestamp']), source.get('language'), author)
+
+    @classmethod
+    def search_load_options(cls):
+        return [so.joinedload(cls.author)]
+
+    @staticmethod
+    def detect_languages(ids):
+        posts = db.session.scalars(sa.select(Post).where(Post.id.in_(ids), Post.language.is_(None))).all()
+        for post, language in zip(posts, detect_languages([post.body for post in posts])):
+            post.language = language
+        db.session.commit()
+        return len(posts)
+
+    @staticmethod
+    def queue_language_detection(ids):
+        try:
+            current_app.task_queue.enqueue('app.tasks.detect_post_languages', list(ids))
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Language detection queue unavailable, detecting synchronously')
+            Post.detect_languages(ids)
+
+    @staticmethod
+    def popular(since, limit):
+        return (sa.select(Post).join(Post.author).options(so.contains_eager(Post.author))
+                .where(Post.timestamp >= since, Post.language.is_not(None), Post.language != '')
+                .order_by(User.followers_total.desc(), Post.timestamp.desc()).limit(limit))
+
+    @staticmethod
+    def author_operations(author_id, session=db.session, chunk_size=1000):
+        last_id = 0
+        while True:
+            query = (sa.select(Post).where(Post.user_id == author_id, Post.id > last_id).order_by(Post.id)
+                     .options(*Post.search_load_options()).limit(chunk_size))
+            posts = session.scalars(query).all()
+            if not posts:
+                return
+            yield [index_operation(Post.__tablename__, post) for post in posts]
+            last_id = posts[-1].id
+
+    @staticmethod
+    def reindex_authors(session, flush_context):
+        authors = session.info.setdefault('reindex_authors', set())
+        authors.update(obj.id for obj in session.dirty if isinstance(obj, User) and
+                       any(sa.inspect(obj).attrs[name].history.has_changes() for name in ('username', 'email')))
+
+    @staticmethod
+    def after_commit_authors(session):
+        for author_id in session.info.pop('reindex_authors', ()):
+            try:
+                current_app.task_queue.enqueue('app.tasks.reindex_author_posts', author_id)
+            except redis.exceptions.RedisError:
+                current_app.logger.warning('Search index queue unavailable, reindexing author posts synchronously')
+                with so.Session(db.engine) as reader:
+                    for operations in Post.author_operations(author_id, reader):
+                        queue_operations(operations)
+
+    @staticmethod
+    def after_rollback_authors(session):
+        session.info.pop('reindex_authors', None)
+
+    @staticmethod
+    def after_insert(mapper, connection, post):
+        connection.execute(sa.update(User.__table__).where(User.__table__.c.id == post.user_id)
+                           .values(posts_total=User.__table__.c.posts_total + 1))
+        connection.execute(timeline.insert().values(user_id=post.user_id, post_id=post.id, author_id=post.user_id, timestamp=post.timestamp))
+        trim = random.random() < current_app.config['TIMELINE_TRIM_PROBABILITY']
+        if connection.scalar(sa.select(is_pulled_author(post.user_id))):
+            if trim:
+                trim_timelines(connection, sa.select(sa.literal(post.user_id)))
+            return
+        connection.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(followers.c.follower_id, sa.literal(post.id), sa.literal(post.user_id), sa.literal(post.timestamp, sa.DateTime))
+            .where(followers.c.followed_id == post.user_id)))
+        if trim:
+            trim_timelines(connection, sa.select(followers.c.follower_id).where(followers.c.followed_id == post.user_id)
+                           .union_all(sa.select(sa.literal(post.user_id))))
+
+    @staticmethod
+    def before_delete(mapper, connection, post):
+        connection.execute(sa.update(User.__table__).where(User.__table__.c.id == post.user_id)
+                           .values(posts_total=User.__table__.c.posts_total - 1))
+        connection.execute(timeline.delete().where(timeline.c.post_id == post.id))
+db.event.listen(Post, 'after_insert', Post.after_insert)
+db.event.listen(Post, 'before_delete', Post.before_delete)
+db.event.listen(db.session, 'after_flush', Post.reindex_authors)
+db.event.listen(db.session, 'after_commit', Post.after_commit_authors)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback_authors)
+
+
+class SearchAuthor(object):
+    def __init__(self, username, avatar_hash):
+        self.username = username
+        self.avatar_hash = avatar_hash
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_hash, size)
+
+
+class SearchPost(object):
+    def __init__(self, id, body, timestamp, language, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = author
 
 
 class Message(db.Model):
@@ -286,6 +946,23 @@ class Notification(db.Model):
 
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    def to_dict(self):
+        return {'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+    @staticmethod
+    def after_commit(session):
+        notifications = session.info.pop('notifications', [])
+        if current_app.config['NOTIFICATION_STORE'] == 'redis':
+            store_notifications(notifications)
+        else:
+            publish_notifications(notifications)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('notifications', None)
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
     
 
 class Task(db.Model):
@@ -305,5 +982,7 @@ class Task(db.Model):
         return rq_job
     
     def get_progres(self):
-        job = self.get_rq_jpb()
-        return job.meta.get('progress', 0) if job is not None else 100
+        progress = task_progress(self.user_id, [self.id]).get(self.id)
+        if progress is None:
+            return 100 if self.complete else 0
+        return progress
@@ -0,0 +1,124 @@
+import json
+import time
+import redis.exceptions
+from flask import current_app
+
+
+def channel(user_id):
+    return f'notifications:{user_id}'
+
+def publish_notifications(notifications):
+    if not notifications:
+        return
+    try:
+        pipeline = current_app.redis.pipeline(transaction=False)
+        for notification in notifications:
+            pipeline.publish(channel(notification['user_id']), json.dumps(notification))
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not publish notifications')
+
+def latest_key(user_id):
+    return f'notifications:{user_id}:latest'
+
+def history_key(user_id):
+    return f'notifications:{user_id}:history'
+
+def store_notifications(notifications):
+    """Upsert ``notifications`` by name into each user's Redis hash and publish them in one transaction.
+
+    Every notification is also appended to a per-user stream capped at
+    NOTIFICATION_HISTORY entries; both keys expire NOTIFICATION_TTL seconds after
+    the last write.
+    """
+    if not notifications:
+        return
+    ttl = current_app.config['NOTIFICATION_TTL']
+    try:
+        pipeline = current_app.redis.pipeline()
+        for notification in notifications:
+            user_id = notification['user_id']
+            payload = json.dumps(notification)
+            pipeline.hset(latest_key(user_id), notification['name'], payload)
+            pipeline.xadd(history_key(user_id), {'notification': payload},
+                          maxlen=current_app.config['NOTIFICATION_HISTORY'], approximate=True)
+            pipeline.expire(latest_key(user_id), ttl)
+            pipeline.expire(history_key(user_id), ttl)
+            pipeline.publish(channel(user_id), payload)
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not store notifications')
+
+def progress_key(user_id):
+    return f'notifications:{user_id}:tasks'
+
+def publish_task_progress(user_id, task_id, progress, ttl):
+    """Record a task's progress in the user's Redis hash and publish it, without touching SQL."""
+    notification = {'user_id': user_id, 'name': 'task_progress',
+                    'data': {'task_id': task_id, 'progress': progress}, 'timestamp': time.time()}
+    payload = json.dumps(notification)
+    try:
+        pipeline = current_app.redis.pipeline(transaction=False)
+        pipeline.hset(progress_key(user_id), task_id, payload)
+        pipeline.expire(progress_key(user_id), ttl)
+        pipeline.publish(channel(user_id), payload)
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not publish task progress')
+
+def task_notifications(user_id, task_ids=None):
+    try:
+        if task_ids is None:
+            values = current_app.redis.hvals(progress_key(user_id))
+        elif task_ids:
+            values = current_app.redis.hmget(progress_key(user_id), task_ids)
+        else:
+            values = []
+    except redis.exceptions.RedisError:
+        return []
+    return [json.loads(value) for value in values if value is not None]
+
+def task_progress(user_id, task_ids):
+    return {notification['data']['task_id']: notification['data']['progress']
+            for notification in task_notifications(user_id, task_ids)}
+
+def stored_notifications(user_id, since):
+    notifications = [json.loads(value) for value in current_app.redis.hvals(latest_key(user_id))]
+    return sorted([{key: notification[key] for key in ('name', 'data', 'timestamp')}
+                   for notification in notifications if notification['timestamp'] > since],
+                  key=lambda notification: notification['timestamp'])
+
+def notification_history(user_id, count=None):
+    entries = current_app.redis.xrevrange(history_key(user_id), count=count)
+    return [json.loads(fields[b'notification']) for id, fields in entries]
+
+def format_event(notification):
+    data = json.dumps({key: notification[key] for key in ('name', 'data', 'timestamp')})
+    return f"id: {notification['timestamp']!r}\nevent: notification\ndata: {data}\n\n"
+
+def event_stream(pubsub, backlog, since, heartbeat, duration, retry):
+    """Yield SSE events: ``backlog`` first, then messages from ``pubsub`` newer than ``since``.
+
+    A comment line is sent after ``heartbeat`` idle seconds to keep proxies from
+    closing the connection, and the stream ends after ``duration`` seconds so the
+    browser reconnects with ``Last-Event-ID`` and frees the worker.
+    """
+    try:
+        yield f'retry: {retry}\n\n'
+        for notification in backlog:
+            since = max(since, notification['timestamp'])
+            yield format_event(notification)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat)
+            if message is None:
+                yield ': heartbeat\n\n'
+                continue
+            notification = json.loads(message['data'])
+            if notification['timestamp'] > since:
+                since = notification['timestamp']
+                yield format_event(notification)
+    except redis.exceptions.RedisError:
+        pass
+    finally:
+        pubsub.close()
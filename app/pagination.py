@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import abort, current_app
+from app import db
+
+
+def encode_cursor(direction, values):
+    values = [{'dt': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    payload = json.dumps([direction, values], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii')
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None, None
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(payload)
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, tuple(datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value
+                                for value in values)
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+
+def _check_values(keys, values):
+    if len(values) != len(keys):
+        abort(400)
+    for key, value in zip(keys, values):
+        expected = key.type.python_type
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            abort(400)
+
+def keyset(query, keys, direction, values):
+    if direction is not None:
+        _check_values(keys, values)
+    query = query.order_by(None)
+    if direction == 'prev':
+        return query.where(sa.tuple_(*keys) > sa.tuple_(*values)).order_by(*[key.asc() for key in keys])
+    if direction == 'next':
+        query = query.where(sa.tuple_(*keys) < sa.tuple_(*values))
+    return query.order_by(*[key.desc() for key in keys])
+
+def approximate_count(query):
+    limit = current_app.config['PAGINATION_COUNT_LIMIT']
+    total = db.session.scalar(sa.select(sa.func.count()).select_from(query.order_by(None).limit(limit).subquery()))
+    return total, total >= limit
+
+
+class KeysetPage(object):
+    def __init__(self, rows, per_page, direction, total=None, total_is_estimate=False):
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if direction == 'prev':
+            rows.reverse()
+        self.items = [row[0] for row in rows]
+        self.per_page = per_page
+        self.has_next = more if direction != 'prev' else True
+        self.has_prev = more if direction == 'prev' else direction == 'next'
+        self.next_cursor = encode_cursor('next', rows[-1][1:]) if self.has_next and rows else None
+        self.prev_cursor = encode_cursor('prev', rows[0][1:]) if self.has_prev and rows else None
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def paginate(query, keys, cursor=None, per_page=10, count=False):
+    """Return a page of ``query`` ordered by ``keys`` (newest first) after ``cursor``.
+
+    No COUNT is issued unless ``count`` is true, in which case the total is
+    counted up to PAGINATION_COUNT_LIMIT rows and flagged as an estimate above it.
+    """
+    direction, values = decode_cursor(cursor)
+    total, total_is_estimate = approximate_count(query) if count else (None, False)
+    page_query = keyset(query, keys, direction, values).add_columns(*keys).limit(per_page + 1)
+    rows = [tuple(row) for row in db.session.execute(page_query)]
+    return KeysetPage(rows, per_page, direction, total, total_is_estimate)
@@ -0,0 +1,76 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = 'Too many password checks in progress, please try again shortly.'
+
+
+class PasswordHasher(object):
+    """Run password hashing in a bounded process pool so it cannot tie up web workers.
+
+    At most ``workers + queue`` hashes may be running or waiting at once; callers
+    beyond that get PasswordHasherBusy (a 503) straight away instead of queueing.
+    A pool broken by a dead worker is replaced once per call before falling back
+    to hashing inline. With ``workers=0`` hashing runs inline in the calling thread.
+    """
+    def __init__(self, method='scrypt', workers=1, queue=0, retry_after=1):
+        self.method = method
+        self.workers = workers
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(workers + queue) if workers else None
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self._prefix = None
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.pid = os.getpid()
+            return self.executor
+
+    def _discard(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy(retry_after=self.retry_after)
+        try:
+            for attempt in range(2):
+                executor = self._pool()
+                try:
+                    return executor.submit(function, *args).result()
+                except BrokenProcessPool:
+                    self._discard(executor)
+            return function(*args)
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
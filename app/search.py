@@ -1,29 +1,410 @@
 from flask import current_app
+from elasticsearch import ApiError, TransportError
+from elasticsearch.helpers import streaming_bulk
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import redis.exceptions
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import re
+
+
+class ElasticsearchBackend(object):
+    def __init__(self, client):
+        self.client = client
+
+    def index(self, index, id, document):
+        self.client.index(index=index, id=id, document=document)
+
+    def delete(self, index, id):
+        self.client.delete(index=index, id=id)
+
+    def search(self, index, query, page, per_page, fields=None):
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': fields or ['*']}},
+            from_=(page-1)*per_page,
+            size=per_page
+        )
+        hits = [(int(hit['_id']), hit.get('_source', {})) for hit in search['hits']['hits']]
+        return hits, search['hits']['total']['value']
+
+    @staticmethod
+    def mappings(fields):
+        """Map every searchable field as text with a search_as_you_type ``suggest`` sub-field,
+        whose shingle sub-fields and prefix index serve autocomplete."""
+        return {'properties': {field: {'type': 'text', 'fields': {'suggest': {'type': 'search_as_you_type'}}}
+                               for field in fields or []}}
+
+    def suggest(self, index, prefix, size, fields=None, budget=None):
+        if fields:
+            fields = [f'{field}.suggest{suffix}' for field in fields for suffix in ('', '._2gram', '._3gram')]
+        try:
+            search = self.client.options(request_timeout=budget).search(
+                index=index,
+                query={'multi_match': {'query': prefix, 'type': 'bool_prefix', 'fields': fields or ['*']}},
+                size=size,
+                terminate_after=size,
+                timeout=f'{int(budget * 1000)}ms' if budget else None
+            )
+        except (ApiError, TransportError):
+            return []
+        return [(int(hit['_id']), hit.get('_source', {})) for hit in search['hits']['hits']]
+
+    def bulk(self, operations):
+        actions = [{key: value for key, value in operation.items() if key != '_searchable'} for operation in operations]
+        results = streaming_bulk(self.client, actions, raise_on_error=False, raise_on_exception=False)
+        failed = []
+        for operation, (ok, item) in zip(operations, results):
+            if not ok and not (operation['_op_type'] == 'delete' and item['delete'].get('status') == 404):
+                failed.append(operation)
+        return failed
+
+    def create_index(self, index, fields=None):
+        if not self.client.indices.exists(index=index):
+            self.client.indices.create(index=index, mappings=self.mappings(fields))
+
+    def swap_index(self, index, target):
+        actions = [{'add': {'index': target, 'alias': index}}]
+        old_indices = []
+        if self.client.indices.exists_alias(name=index):
+            old_indices = [old for old in self.client.indices.get_alias(name=index) if old != target]
+            actions = [{'remove': {'index': old, 'alias': index}} for old in old_indices] + actions
+        elif self.client.indices.exists(index=index):
+            actions.insert(0, {'remove_index': {'index': index}})
+        self.client.indices.update_aliases(actions=actions)
+        for old in old_indices:
+            self.client.indices.delete(index=old)
+
+
+class SQLiteFTSBackend(object):
+    """Full-text search in a local SQLite database with one FTS5 table per index.
+
+    Rows are keyed by the model id (the FTS rowid); ``content`` holds the
+    searchable fields of the document and ``document`` the whole document as JSON.
+    """
+    def __init__(self, path):
+        if path == ':memory:':
+            path = f'file:search-{id(self)}?mode=memory&cache=shared'
+        self.path = path
+        self.local = threading.local()
+        self.tables = set()
+        self.keepalive = self.connection() if path.startswith('file:') else None
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, uri=self.path.startswith('file:'), timeout=30,
+                                         isolation_level=None, check_same_thread=False)
+            if not self.path.startswith('file:'):
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def create_index(self, index, fields=None):
+        if index not in self.tables:
+            self.connection().execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" USING fts5(content, document UNINDEXED, prefix=\'2 3\')')
+            self.tables.add(index)
+
+    def swap_index(self, index, target):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(f'DROP TABLE IF EXISTS "{index}"')
+            connection.execute(f'ALTER TABLE "{target}" RENAME TO "{index}"')
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        self.tables.discard(target)
+
+    def _apply(self, connection, operation):
+        index = operation['_index']
+        self.create_index(index)
+        if operation['_op_type'] == 'delete':
+            connection.execute(f'DELETE FROM "{index}" WHERE rowid = ?', (operation['_id'],))
+        else:
+            document = operation['_source']
+            fields = operation.get('_searchable') or document.keys()
+            content = ' '.join(str(document[field]) for field in fields if document.get(field) is not None)
+            connection.execute(f'INSERT OR REPLACE INTO "{index}" (rowid, content, document) VALUES (?, ?, ?)',
+                               (operation['_id'], content, json.dumps(document, default=str)))
+
+    def index(self, index, id, document):
+        self.bulk([{'_op_type': 'index', '_index': index, '_id': id, '_source': document}])
+
+    def delete(self, index, id):
+        self.bulk([{'_op_type': 'delete', '_index': index, '_id': id}])
+
+    def bulk(self, operations):
+        connection = self.connection()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            for operation in operations:
+                self._apply(connection, operation)
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            return operations
+        return []
+
+    @staticmethod
+    def match_expression(query):
+        terms = re.findall(r'\w+', query)
+        return ' OR '.join('"' + term + '"' for term in terms)
+
+    def search(self, index, query, page, per_page, fields=None):
+        expression = self.match_expression(query)
+        if not expression:
+            return [], 0
+        self.create_index(index)
+        connection = self.connection()
+        rows = connection.execute(f'SELECT rowid, document FROM "{index}" WHERE "{index}" MATCH ? '
+                                  f'ORDER BY rank LIMIT ? OFFSET ?', (expression, per_page, (page-1)*per_page)).fetchall()
+        total = connection.execute(f'SELECT count(*) FROM "{index}" WHERE "{index}" MATCH ?', (expression,)).fetchone()[0]
+        return [(row[0], json.loads(row[1])) for row in rows], total
+
+    def suggest(self, index, prefix, size, fields=None, budget=None):
+        terms = re.findall(r'\w+', prefix)
+        if not terms:
+            return []
+        expression = ' AND '.join('"' + term + '"' for term in terms) + '*'
+        self.create_index(index)
+        connection = self.connection()
+        if budget:
+            deadline = time.monotonic() + budget
+            connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        hits = []
+        try:
+            rows = connection.execute(f'SELECT rowid, document FROM "{index}" WHERE "{index}" MATCH ? '
+                                      f'ORDER BY rowid DESC LIMIT ?', (expression, size))
+            for row in rows:
+                hits.append((row[0], json.loads(row[1])))
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            connection.set_progress_handler(None, 0)
+        return hits
+
+
+def document(model):
+    return model.search_document()
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    current_app.search_backend.index(index, model.id, document(model))
 
 def remove_from_object(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.delete(index, model.id)
+
+def _cache_key(index, *parts):
+    generation = int(current_app.redis.get(f'search:generation:{index}') or 0)
+    digest = hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+    return f'search:cache:{index}:{generation}:{digest}'
+
+def _bump_generations(indices):
+    try:
+        for index in set(indices):
+            current_app.redis.incr(f'search:generation:{index}')
+    except redis.exceptions.RedisError:
+        pass
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+def _cached(index, ttl, parts, compute):
+    key = cached = None
+    if ttl:
+        try:
+            key = _cache_key(index, *parts)
+            cached = current_app.redis.get(key)
+        except redis.exceptions.RedisError:
+            key = None
+    if cached is not None:
+        _count('cache_hits', 1)
+        return json.loads(cached)
+    result = compute()
+    if key is not None:
+        _count('cache_misses', 1)
+        try:
+            current_app.redis.set(key, json.dumps(result, default=str), ex=ttl)
+        except redis.exceptions.RedisError:
+            pass
+    return result
+
+def query_documents(index, query, page, per_page, fields=None):
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page-1)*per_page,
-        size=per_page
-    )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    hits, total = _cached(index, current_app.config['SEARCH_CACHE_TTL'], ['search', query, page, per_page, fields],
+                          lambda: current_app.search_backend.search(index, query, page, per_page, fields=fields))
+    return [tuple(hit) for hit in hits], total
+
+def suggest_documents(index, prefix, size, fields=None):
+    prefix = ' '.join(prefix.lower().split())
+    if not current_app.search_backend or len(prefix) < 2:
+        return []
+    budget = current_app.config['SEARCH_SUGGEST_BUDGET']
+    hits = _cached(index, current_app.config['SEARCH_SUGGEST_TTL'], ['suggest', prefix, size, fields],
+                   lambda: current_app.search_backend.suggest(index, prefix, size, fields=fields, budget=budget))
+    return [tuple(hit) for hit in hits]
+
+def query_index(index, query, page, per_page, fields=None):
+    hits, total = query_documents(index, query, page, per_page, fields=fields)
+    return [id for id, source in hits], total
+
+def index_operation(index, model):
+    return {'_op_type': 'index', '_index': index, '_id': model.id, '_source': document(model),
+            '_searchable': list(model.__searchable__)}
+
+def delete_operation(index, model):
+    return {'_op_type': 'delete', '_index': index, '_id': model.id}
+
+def _count(field, amount):
+    try:
+        current_app.redis.hincrby('search:stats', field, amount)
+    except redis.exceptions.RedisError:
+        pass
+
+def index_stats():
+    try:
+        stats = current_app.redis.hgetall('search:stats')
+    except redis.exceptions.RedisError:
+        return {}
+    return {key.decode(): int(value) for key, value in stats.items()}
+
+def _shadow_operations(operations):
+    try:
+        shadows = current_app.redis.hgetall('search:shadow')
+    except redis.exceptions.RedisError:
+        return []
+    shadows = {index.decode(): target.decode() for index, target in shadows.items()}
+    return [dict(operation, _index=shadows[operation['_index']])
+            for operation in operations if operation['_index'] in shadows]
+
+def _enqueue_operations(operations):
+    try:
+        current_app.task_queue.enqueue('app.tasks.index_documents', operations)
+    except redis.exceptions.RedisError:
+        return False
+    return True
+
+def queue_operations(operations):
+    """Index ``operations`` after a commit without making the request wait on retries.
+
+    With SEARCH_INDEX_ASYNC everything goes to the worker. Otherwise one bulk
+    request is made inline and only the operations that failed are handed to the
+    worker, which retries them with backoff.
+    """
+    if not current_app.search_backend or not operations:
+        return
+    operations = operations + _shadow_operations(operations)
+    _count('pending', len(operations))
+    _bump_generations(operation['_index'] for operation in operations)
+    if current_app.config['SEARCH_INDEX_ASYNC']:
+        if _enqueue_operations(operations):
+            return
+        current_app.logger.warning('Search index queue unavailable, indexing synchronously')
+    failed = current_app.search_backend.bulk(operations)
+    _count('pending', len(failed) - len(operations))
+    _bump_generations(operation['_index'] for operation in operations)
+    if failed and not _enqueue_operations(failed):
+        _count('pending', -len(failed))
+        _count('failed', len(failed))
+        current_app.logger.error(f'Failed to index {len(failed)} search documents')
+
+def process_operations(operations):
+    failed = bulk_index(operations)
+    _count('pending', -len(operations))
+    _bump_generations(operation['_index'] for operation in operations)
+    return failed
+
+def bulk_index(operations):
+    pending = operations
+    retries = current_app.config['SEARCH_INDEX_RETRIES']
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(current_app.config['SEARCH_INDEX_BACKOFF'] * 2 ** (attempt - 1), 60))
+        pending = current_app.search_backend.bulk(pending)
+        if not pending:
+            break
+    if pending:
+        _count('failed', len(pending))
+        current_app.logger.error(f'Failed to index {len(pending)} search documents')
+    return pending
+
+def _index_chunk(app, operations):
+    with app.app_context():
+        return bulk_index(operations)
+
+def _checkpoint(name):
+    try:
+        state = current_app.redis.hgetall(name)
+    except redis.exceptions.RedisError:
+        return {}
+    return {key.decode(): value.decode() for key, value in state.items()}
+
+def _save_checkpoint(name, mapping):
+    try:
+        current_app.redis.hset(name, mapping=mapping)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not save checkpoint {name}, continuing without checkpoints')
+        return False
+    return True
+
+def rebuild_index(index, load_chunks, workers=4, resume=False, new_index=False, fields=None):
+    """Index every document returned by ``load_chunks(after_id)`` with parallel bulk requests.
+
+    Progress is checkpointed in Redis after each completed chunk so an interrupted
+    run can continue with ``resume``; without Redis the rebuild runs unchecked. With
+    ``new_index`` the documents go to a fresh index, live changes are written to
+    both, and the ``index`` alias is swapped to the new index at the end; this needs
+    Redis to register the shadow index and raises RedisError without it. A missing
+    index is created with the backend's mapping for the searchable ``fields``.
+    """
+    backend = current_app.search_backend
+    name = f'search:reindex:{index}'
+    state = _checkpoint(name) if resume else {}
+    last_id = int(state.get('last_id', 0))
+    target = state.get('target') or (f'{index}-{int(time.time())}' if new_index else index)
+    backend.create_index(target, fields)
+    if target != index:
+        current_app.redis.hset('search:shadow', index, target)
+    checkpoints = _save_checkpoint(name, {'target': target, 'last_id': last_id})
+
+    app = current_app._get_current_object()
+    indexed = failed = 0
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def complete_oldest():
+            nonlocal indexed, failed, checkpoints
+            future, chunk_size, chunk_last_id = in_flight.popleft()
+            errors = len(future.result())
+            indexed += chunk_size - errors
+            failed += errors
+            if checkpoints:
+                checkpoints = _save_checkpoint(name, {'last_id': chunk_last_id})
 
+        for chunk in load_chunks(last_id):
+            operations = [index_operation(target, model) for model in chunk]
+            in_flight.append((executor.submit(_index_chunk, app, operations), len(operations), chunk[-1].id))
+            while in_flight and (len(in_flight) > 2 * workers or in_flight[0][0].done()):
+                complete_oldest()
+        while in_flight:
+            complete_oldest()
 
-    
\ No newline at end of file
+    if target != index:
+        backend.swap_index(index, target)
+    _bump_generations([index])
+    try:
+        if target != index:
+            current_app.redis.hdel('search:shadow', index)
+        current_app.redis.delete(name)
+    except redis.exceptions.RedisError:
+        current_app.logger.error(f'Could not clear reindex state of {index}')
+    return indexed, failed
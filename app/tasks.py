@@ -3,48 +3,117 @@ from app import db
 from app.models import Task, User, Post
 from rq import get_current_job
 import sys
+import os
+import gzip
+import tempfile
 import sqlalchemy as sa
 import time
 from app.email import send_mail
+from app.search import process_operations
+from app.translate import stored_translations, translate_posts
+from app.language import detector_factory
+from app.notifications import publish_task_progress
+from datetime import datetime, timezone, timedelta
 from flask import render_template
 import json
 
 app = create_app()
 app.app_context().push()
+detector_factory()
+
+_progress_reported = {}
+
 
 def _set_task_progress(progress):
+    """Report progress through job meta and Redis pub/sub, at most once per
+    TASK_PROGRESS_INTERVAL; SQL is only written when the task completes."""
     job = get_current_job()
-    if job():
-        job.meta['progress'] = progress
-        job.save_meta()
-        task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': task.id, 'progress': progress})
-        if progress >= 100:
+    if not job:
+        return
+    now = time.monotonic()
+    if progress < 100 and now - _progress_reported.get(job.id, float('-inf')) < app.config['TASK_PROGRESS_INTERVAL']:
+        return
+    _progress_reported[job.id] = now
+    job.meta['progress'] = progress
+    job.save_meta()
+    if 'user_id' in job.meta:
+        publish_task_progress(job.meta['user_id'], job.id, progress, app.config['TASK_PROGRESS_TTL'])
+    if progress >= 100:
+        _progress_reported.pop(job.id, None)
+        task = db.session.get(Task, job.id)
+        if task is not None:
             task.complete = True
-        db.session.commit()
+            db.session.commit()
+
+
+def _write_posts(file, user):
+    """Stream ``user``'s posts into ``file`` as gzipped NDJSON, reporting progress every
+    EXPORT_PROGRESS_ROWS rows or EXPORT_PROGRESS_INTERVAL seconds, whichever comes first."""
+    total = user.posts_count()
+    query = (sa.select(Post.body, Post.timestamp).where(Post.user_id == user.id).order_by(Post.timestamp.asc())
+             .execution_options(yield_per=app.config['EXPORT_BATCH_SIZE']))
+    reported_rows, reported_at, progress = 0, time.monotonic(), 0
+    with gzip.open(file, 'wt', encoding='utf-8') as archive:
+        for i, (body, timestamp) in enumerate(db.session.execute(query), 1):
+            archive.write(json.dumps({'body': body, 'timestamp': timestamp.isoformat() + 'Z'}) + '\n')
+            if (i - reported_rows >= app.config['EXPORT_PROGRESS_ROWS']
+                    or time.monotonic() - reported_at >= app.config['EXPORT_PROGRESS_INTERVAL']):
+                reported_rows, reported_at = i, time.monotonic()
+                percent = min(99, 100 * i // max(total, 1))
+                if percent > progress:
+                    progress = percent
+                    _set_task_progress(progress)
 
 
 def export_posts(user_id):
     try:
         user = db.session.get(User, user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalars(sa.select(sa.func.count()).select_from(user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i+=1
-            _set_task_progress(100 * i // total_posts)
+        os.makedirs(app.config['EXPORT_DIR'], exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=app.config['EXPORT_DIR'], suffix='.tmp', delete=False) as file:
+            try:
+                _write_posts(file, user)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, user.export_path())
+        attachments = None
+        if os.path.getsize(user.export_path()) <= app.config['EXPORT_ATTACHMENT_MAX']:
+            with open(user.export_path(), 'rb') as file:
+                attachments = [('posts.ndjson.gz', 'application/gzip', file.read())]
         send_mail("[Microblog] Your blog posts",
                   sender=app.config['ADMINS'][0], recipients=[user.email],
-                  text_body=render_template('email/export_posts.txt', user=user),
-                  html_body=render_template('email/export_posts.html', user=user),
-                  attachments=[('post.json', 'application/json', json.dumps({'posts': data}, indent=4))],
-                  sync=True)
+                  text_body=render_template('email/export_posts.txt', user=user, attached=attachments is not None),
+                  html_body=render_template('email/export_posts.html', user=user, attached=attachments is not None),
+                  attachments=attachments, sync=True)
     except Exception:
-        _set_task_progress(100)
         app.logger.error("Unhandled exception", exc_info=sys.exc_info())
     finally:
-        _set_task_progress(100)
\ No newline at end of file
+        _set_task_progress(100)
+
+
+def index_documents(operations):
+    process_operations(operations)
+
+
+def reindex_author_posts(author_id):
+    for operations in Post.author_operations(author_id):
+        process_operations(operations)
+
+
+def pretranslate_posts(window, limit):
+    since = datetime.now(timezone.utc) - timedelta(seconds=window)
+    posts = db.session.scalars(Post.popular(since, limit)).all()
+    for dest in app.config['LANGUAGES']:
+        stored = stored_translations(posts, dest)
+        items = [(post.id, post.body, post.language, dest) for post in posts
+                 if post.language != dest and post.id not in stored]
+        translate_posts(items, workers=app.config['TRANSLATE_BATCH_WORKERS'])
+
+
+def detect_post_languages(post_ids):
+    Post.detect_languages(post_ids)
+
+
+def flush_last_seen():
+    User.flush_last_seen()
@@ -1,12 +1,156 @@
+import hashlib
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+import time
+import redis.exceptions
 import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
 from flask_babel import _
+from app.cache import SingleFlight
+
+TRANSLATE_URL = 'https://api.mymemory.translated.net/get'
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+flights = SingleFlight()
+
+
+class TranslationError(Exception):
+    pass
+
+
+def _count(field):
+    try:
+        current_app.redis.hincrby('translate:stats', field, 1)
+    except redis.exceptions.RedisError:
+        pass
+
+def translation_stats():
+    try:
+        stats = current_app.redis.hgetall('translate:stats')
+    except redis.exceptions.RedisError:
+        return {}
+    return {key.decode(): int(value) for key, value in stats.items()}
+
+def translation_key(text, source_lang, dest_lang):
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return f'translate:{source_lang}:{dest_lang}:{digest}'
+
+def _request(text, source_lang, dest_lang):
+    _count('upstream')
+    timeout = (current_app.config['TRANSLATE_CONNECT_TIMEOUT'], current_app.config['TRANSLATE_READ_TIMEOUT'])
+    response = session.get(TRANSLATE_URL, params={'q': text, 'langpair': f'{source_lang}|{dest_lang}'}, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if data.get('responseStatus') != 200:
+        raise TranslationError(data.get('responseDetails'))
+    return data['responseData']['translatedText']
+
+def _cached_request(key, text, source_lang, dest_lang):
+    wait = current_app.config['TRANSLATE_CONNECT_TIMEOUT'] + current_app.config['TRANSLATE_READ_TIMEOUT']
+    lock = f'{key}:lock'
+    token = None
+    try:
+        translation = current_app.redis.get(key)
+        if translation is not None:
+            _count('redis_hits')
+            return translation.decode('utf-8')
+        owner = secrets.token_hex(16)
+        if current_app.redis.set(lock, owner, nx=True, ex=int(wait) + 1):
+            token = owner
+        else:
+            deadline = time.monotonic() + wait
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                translation = current_app.redis.get(key)
+                if translation is not None:
+                    _count('coalesced')
+                    return translation.decode('utf-8')
+    except redis.exceptions.RedisError:
+        return _request(text, source_lang, dest_lang)
+    try:
+        translation = _request(text, source_lang, dest_lang)
+        current_app.redis.set(key, translation, ex=current_app.config['TRANSLATE_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+    finally:
+        if token is not None:
+            try:
+                current_app.redis.eval(RELEASE_LOCK, 1, lock, token)
+            except redis.exceptions.RedisError:
+                pass
+    return translation
+
+def translate_text(text, source_lang, dest_lang):
+    key = translation_key(text, source_lang, dest_lang)
+    translation = current_app.translations.get(key)
+    if translation is not None:
+        _count('memory_hits')
+        return translation
+    try:
+        translation, shared = flights.do(key, lambda: _cached_request(key, text, source_lang, dest_lang))
+    except (requests.RequestException, ValueError, KeyError) as error:
+        _count('errors')
+        raise TranslationError(str(error)) from error
+    except TranslationError:
+        _count('errors')
+        raise
+    if shared:
+        _count('coalesced')
+    current_app.translations.set(key, translation)
+    return translation
 
 def translate(text, source_lang, dest_lang):
-    url = f"https://api.mymemory.translated.net/get?q={text}&langpair={source_lang}|{dest_lang}"
     try:
-        responce = requests.post(url=url)
-        responce.raise_for_status()
-        return responce.json()['responseData']['translatedText']
-    except:
+        return translate_text(text, source_lang, dest_lang)
+    except TranslationError:
         return _("Error: the translation service failed.")
 
+def post_translation_key(post_id, dest_lang):
+    return f'translate:post:{post_id}:{dest_lang}'
+
+def stored_translations(posts, dest_lang):
+    posts = [post for post in posts if getattr(post, 'language', None) and post.language != dest_lang]
+    if not posts:
+        return {}
+    try:
+        values = current_app.redis.mget([post_translation_key(post.id, dest_lang) for post in posts])
+    except redis.exceptions.RedisError:
+        return {}
+    return {post.id: value.decode('utf-8') for post, value in zip(posts, values) if value is not None}
+
+def _translate_item(app, text, source_lang, dest_lang):
+    with app.app_context():
+        try:
+            return translate_text(text, source_lang, dest_lang)
+        except TranslationError:
+            return None
+
+def translate_posts(items, workers=4):
+    """Translate ``(post_id, text, source_lang, dest_lang)`` items with at most ``workers`` upstream calls in flight.
+
+    Successful translations are stored under the post id so pages can render them
+    with a single MGET; failed items come back as None.
+    """
+    if not items:
+        return []
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        translations = list(executor.map(lambda item: _translate_item(app, *item[1:]), items))
+    try:
+        pipeline = current_app.redis.pipeline(transaction=False)
+        for (post_id, text, source_lang, dest_lang), translation in zip(items, translations):
+            if translation is not None:
+                pipeline.set(post_translation_key(post_id, dest_lang), translation,
+                             ex=current_app.config['TRANSLATE_CACHE_TTL'])
+        pipeline.execute()
+    except redis.exceptions.RedisError:
+        pass
+    return translations
@@ -0,0 +1,61 @@
+"""Password verification throughput of the hashing pool, to size PASSWORD_HASH_WORKERS.
+
+Run from the project root:
+
+    python benchmarks/passwords.py [--hashes 200] [--workers 4]
+
+Every method is measured inline (workers=0) and through the process pool with
+1..--workers processes kept fully busy; hashes/s per core is the throughput
+divided by the number of processes doing the hashing.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MAIL_SERVER', 'localhost')
+os.environ.setdefault('MAIL_PORT', '25')
+
+from app.passwords import PasswordHasher
+
+
+def run(method, workers, args):
+    hasher = PasswordHasher(method, workers, queue=workers)
+    password_hash = hasher.hash('benchmark')
+    latencies = []
+
+    def verify(_):
+        start = time.perf_counter()
+        hasher.verify(password_hash, 'benchmark')
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        list(executor.map(verify, range(args.hashes)))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    rate = args.hashes / elapsed
+    print(f"{method:<24} {workers:>7} {rate:>10.1f} {rate / max(workers, 1):>10.1f} "
+          f"{statistics.median(latencies):>9.1f} {p95:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--methods', nargs='+', default=['scrypt', 'pbkdf2:sha256'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--hashes', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'method':<24} {'workers':>7} {'hashes/s':>10} {'per core':>10} {'p50 ms':>9} {'p95 ms':>9}")
+    for method in args.methods:
+        for workers in range(args.workers + 1):
+            run(method, workers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Indexing throughput and query latency of the search backends.
+
+Run from the project root:
+
+    python benchmarks/search.py [--documents 200000]
+
+The SQLite FTS5 backend is always measured in a temporary database; the
+Elasticsearch backend is measured too when ELASTICSEARCH_URL is set.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MAIL_SERVER', 'localhost')
+os.environ.setdefault('MAIL_PORT', '25')
+
+from elasticsearch import Elasticsearch
+from app.search import ElasticsearchBackend, SQLiteFTSBackend
+
+INDEX = 'benchmark_post'
+
+
+def vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def documents(count, words, rng):
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    for id in range(1, count + 1):
+        yield id, {'body': ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(5, 25)))}
+
+
+def run(name, backend, args, refresh=None):
+    rng = random.Random(42)
+    words = vocabulary(args.vocabulary, rng)
+    operations = [{'_op_type': 'index', '_index': INDEX, '_id': id, '_source': document}
+                  for id, document in documents(args.documents, words, rng)]
+    start = time.perf_counter()
+    for i in range(0, len(operations), args.chunk_size):
+        backend.bulk(operations[i:i + args.chunk_size])
+    if refresh:
+        refresh()
+    indexing = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(args.queries):
+        query = ' '.join(rng.sample(words[:2000], rng.randint(1, 2)))
+        start = time.perf_counter()
+        backend.search(INDEX, query, rng.randint(1, 5), 10)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<14} {args.documents / indexing:>12.0f} {statistics.median(latencies):>9.2f} {p95:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=200000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'backend':<14} {'docs/s':>12} {'p50 ms':>9} {'p95 ms':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        run('sqlite-fts5', SQLiteFTSBackend(os.path.join(directory, 'search.db')), args)
+    if os.environ.get('ELASTICSEARCH_URL'):
+        client = Elasticsearch(os.environ['ELASTICSEARCH_URL'])
+        client.options(ignore_status=404).indices.delete(index=INDEX)
+        run('elasticsearch', ElasticsearchBackend(client), args, refresh=lambda: client.indices.refresh(index=INDEX))
+        client.indices.delete(index=INDEX)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Read/write cost of the home timeline for different follower distributions.
+
+Run from the project root:
+
+    python benchmarks/timeline.py [--users 2000] [--posts 5]
+
+Every distribution is measured with push only (no pulled authors), hybrid
+(authors with at least --threshold followers are pulled) and pull only; the
+pulled column counts the authors whose posts are read at request time.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MAIL_SERVER', 'localhost')
+os.environ.setdefault('MAIL_PORT', '25')
+
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post, followers, timeline
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_SQLITE_PATH = ':memory:'
+    TESTING = True
+
+
+def uniform(users, follows, rng):
+    for follower in range(users):
+        for followed in rng.sample(range(users), follows):
+            yield follower, followed
+
+
+def skewed(users, follows, rng):
+    weights = [1 / (rank + 1) for rank in range(users)]
+    for follower in range(users):
+        for followed in set(rng.choices(range(users), weights=weights, k=follows)):
+            yield follower, followed
+
+
+def run(distribution, threshold, args):
+    app = create_app(BenchmarkConfig)
+    app.config['TIMELINE_PULL_THRESHOLD'] = threshold
+    with app.app_context():
+        db.create_all()
+        rng = random.Random(42)
+        db.session.execute(sa.insert(User), [{'username': f'user{i}', 'email': f'user{i}@example.com'}
+                                             for i in range(1, args.users + 1)])
+        edges = {(a + 1, b + 1) for a, b in distribution(args.users, args.follows, rng) if a != b}
+        db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in edges])
+        db.session.execute(sa.update(User).values(
+            followers_total=sa.select(sa.func.count()).where(followers.c.followed_id == User.id).scalar_subquery(),
+            following_total=sa.select(sa.func.count()).where(followers.c.follower_id == User.id).scalar_subquery()))
+        db.session.commit()
+        pulled = db.session.scalar(sa.select(sa.func.count()).where(User.followers_total >= threshold))
+
+        authors = [rng.randint(1, args.users) for _ in range(args.users * args.posts)]
+        now = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        for i, author_id in enumerate(authors):
+            db.session.add(Post(body=f'post {i}', user_id=author_id, timestamp=now + timedelta(seconds=i)))
+            db.session.commit()
+        write = (time.perf_counter() - start) / len(authors)
+        rows = db.session.scalar(sa.select(sa.func.count()).select_from(timeline))
+
+        readers = [db.session.get(User, rng.randint(1, args.users)) for _ in range(args.reads)]
+        start = time.perf_counter()
+        for user in readers:
+            user.timeline(None, BenchmarkConfig.POSTS_PER_PAGE)
+        read = (time.perf_counter() - start) / len(readers)
+        db.session.remove()
+        db.drop_all()
+    return write, read, rows, pulled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=5, help='posts per user')
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--threshold', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'distribution':<12} {'strategy':<10} {'pulled':>7} {'write ms/post':>14} {'timeline rows':>14} {'read ms/page':>13}")
+    for name, distribution in [('uniform', uniform), ('skewed', skewed)]:
+        for strategy, threshold in [('push', sys.maxsize), ('hybrid', args.threshold), ('pull', 0)]:
+            write, read, rows, pulled = run(distribution, threshold, args)
+            if strategy == 'hybrid' and not pulled:
+                parser.error(f'no {name} author has {args.threshold} followers, lower --threshold')
+            print(f"{name:<12} {strategy:<10} {pulled:>7} {write * 1000:>14.3f} {rows:>14} {read * 1000:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
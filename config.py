@@ -15,6 +15,50 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = [MAIL_USERNAME]
     POSTS_PER_PAGE = 10
+    PAGINATION_COUNT_LIMIT = 10000
+    API_MAX_IDS = 500
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 1000)
+    TIMELINE_PULL_THRESHOLD = int(os.environ.get('TIMELINE_PULL_THRESHOLD') or 10000)
+    TIMELINE_TRIM_PROBABILITY = float(os.environ.get('TIMELINE_TRIM_PROBABILITY') or 0.01)
     LANGUAGES = ["en", "ru"]
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH', os.path.join(basedir, 'search.db'))
+    SEARCH_INDEX_ASYNC = os.environ.get('SEARCH_INDEX_ASYNC') is not None
+    SEARCH_INDEX_RETRIES = int(os.environ.get('SEARCH_INDEX_RETRIES') or 3)
+    SEARCH_INDEX_BACKOFF = float(os.environ.get('SEARCH_INDEX_BACKOFF') or 0.5)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    SEARCH_SUGGEST_TTL = int(os.environ.get('SEARCH_SUGGEST_TTL') or 30)
+    SUGGESTIONS_PER_TYPE = 5
+    SEARCH_SUGGEST_BUDGET = float(os.environ.get('SEARCH_SUGGEST_BUDGET') or 0.05)
+    TRANSLATE_CONNECT_TIMEOUT = float(os.environ.get('TRANSLATE_CONNECT_TIMEOUT') or 2)
+    TRANSLATE_READ_TIMEOUT = float(os.environ.get('TRANSLATE_READ_TIMEOUT') or 5)
+    TRANSLATE_CACHE_SIZE = int(os.environ.get('TRANSLATE_CACHE_SIZE') or 4096)
+    TRANSLATE_CACHE_TTL = int(os.environ.get('TRANSLATE_CACHE_TTL') or 30 * 24 * 3600)
+    TRANSLATE_BATCH_MAX = 50
+    TRANSLATE_BATCH_WORKERS = int(os.environ.get('TRANSLATE_BATCH_WORKERS') or 4)
+    PRETRANSLATE_WINDOW = int(os.environ.get('PRETRANSLATE_WINDOW') or 24 * 3600)
+    PRETRANSLATE_LIMIT = int(os.environ.get('PRETRANSLATE_LIMIT') or 200)
+    NOTIFICATION_STORE = os.environ.get('NOTIFICATION_STORE') or 'sql'
+    NOTIFICATION_TTL = int(os.environ.get('NOTIFICATION_TTL') or 7 * 24 * 3600)
+    NOTIFICATION_HISTORY = int(os.environ.get('NOTIFICATION_HISTORY') or 100)
+    NOTIFICATION_HEARTBEAT = int(os.environ.get('NOTIFICATION_HEARTBEAT') or 15)
+    NOTIFICATION_STREAM_DURATION = int(os.environ.get('NOTIFICATION_STREAM_DURATION') or 300)
+    NOTIFICATION_RETRY = 3000
+    LAST_SEEN_RESOLUTION = int(os.environ.get('LAST_SEEN_RESOLUTION') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    LAST_SEEN_THROTTLE_SIZE = 100000
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 300)
+    TASK_PROGRESS_INTERVAL = float(os.environ.get('TASK_PROGRESS_INTERVAL') or 1)
+    TASK_PROGRESS_TTL = int(os.environ.get('TASK_PROGRESS_TTL') or 24 * 3600)
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+    EXPORT_ATTACHMENT_MAX = int(os.environ.get('EXPORT_ATTACHMENT_MAX') or 5 * 1024 * 1024)
+    EXPORT_PROGRESS_ROWS = int(os.environ.get('EXPORT_PROGRESS_ROWS') or 1000)
+    EXPORT_PROGRESS_INTERVAL = float(os.environ.get('EXPORT_PROGRESS_INTERVAL') or 2)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
@@ -3,13 +3,139 @@ import os
 
 from datetime import datetime, timezone, timedelta
 import unittest
-from app import db, create_app
-from app.models import User, Post
+import gzip
+import importlib
+import shutil
+import tempfile
+from flask import g
+from flask_login import FlaskLoginClient
+from unittest import mock
+from app import db, create_app, mail
+from app.models import User, Post, Notification, Task, followers, timeline
+from app.pagination import paginate, encode_cursor
+from werkzeug.exceptions import BadRequest
+from app.search import ElasticsearchBackend, index_stats, process_operations
+from app.language import detect_languages
+from app.notifications import event_stream, notification_history, publish_task_progress
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+from app.translate import translate, translation_key, translate_posts, stored_translations, RELEASE_LOCK
+import requests
+import redis
+import redis.exceptions
+import threading
+import time
+import sqlalchemy as sa
 from config import Config
 
 class Testbing(Config):
     SQLALCHEMY_DATABASE_URI='sqlite://'
+    SEARCH_SQLITE_PATH=':memory:'
     TESTING=True
+    PASSWORD_HASH_WORKERS=0
+
+class DictRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False, exat=None):
+        if nx and key in self.data:
+            return False
+        self.data[key] = str(value).encode('utf-8')
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def eval(self, script, numkeys, key, token):
+        assert script == RELEASE_LOCK
+        if self.data.get(key) != str(token).encode('utf-8'):
+            return 0
+        del self.data[key]
+        return 1
+
+    def pipeline(self, transaction=True):
+        return DictPipeline(self)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode('utf-8')
+
+    def hincrby(self, name, key, amount):
+        values = self.data.setdefault(name, {})
+        values[key.encode('utf-8')] = str(int(values.get(key.encode('utf-8'), 0)) + amount).encode('utf-8')
+
+    def hgetall(self, name):
+        return self.data.get(name, {})
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        values = self.data.setdefault(name, {})
+        for key, value in ([(key, value)] if mapping is None else mapping.items()):
+            values[str(key).encode('utf-8')] = str(value).encode('utf-8')
+
+    def hdel(self, name, key):
+        self.data.get(name, {}).pop(str(key).encode('utf-8'), None)
+
+    def hmget(self, name, keys):
+        return [self.data.get(name, {}).get(str(key).encode('utf-8')) for key in keys]
+
+    def exists(self, name):
+        return int(name in self.data)
+
+    def rename(self, name, new_name):
+        if name not in self.data:
+            raise redis.exceptions.ResponseError('no such key')
+        self.data[new_name] = self.data.pop(name)
+
+    def hvals(self, name):
+        return list(self.data.get(name, {}).values())
+
+    def xadd(self, name, fields, maxlen=None, approximate=True):
+        entries = self.data.setdefault(name, [])
+        entries.append({key.encode('utf-8'): value.encode('utf-8') for key, value in fields.items()})
+        del entries[:-maxlen]
+
+    def xrevrange(self, name, count=None):
+        return [(None, fields) for fields in reversed(self.data.get(name, []))][:count]
+
+    def expire(self, name, ttl):
+        pass
+
+    def publish(self, channel, message):
+        pass
+
+    def pubsub(self, **kwargs):
+        return DictPubSub()
+
+class DictPubSub(object):
+    def subscribe(self, *args, **kwargs):
+        raise redis.exceptions.ConnectionError('pub/sub is not supported')
+
+    def close(self):
+        pass
+
+class DictPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((getattr(self.redis, name), args, kwargs))
+
+    def execute(self):
+        return [method(*args, **kwargs) for method, args, kwargs in self.calls]
+
+def import_tasks():
+    """Import app.tasks without creating and pushing the worker's own app."""
+    with mock.patch('app.create_app'):
+        return importlib.import_module('app.tasks')
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -29,6 +155,49 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('scrypt:'))
+        self.app.password_hasher = PasswordHasher('pbkdf2:sha256:1000')
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('scrypt:'))
+        u.about_me = 'not committed'
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(self.app.password_hasher.needs_rehash(u.password_hash))
+        db.session.rollback()
+        self.assertIsNone(u.about_me)
+        self.assertTrue(u.password_hash.startswith('scrypt:'))
+        self.assertTrue(u.check_password('cat'))
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hasher_pool(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, queue=0)
+        try:
+            password_hash = hasher.hash('cat')
+            self.assertTrue(hasher.verify(password_hash, 'cat'))
+            self.assertFalse(hasher.verify(password_hash, 'dog'))
+            hasher.slots.acquire()
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.verify(password_hash, 'cat')
+            hasher.slots.release()
+            self.assertTrue(hasher.verify(password_hash, 'cat'))
+            broken = hasher.executor
+            for process in list(broken._processes.values()):
+                process.kill()
+                process.join()
+            self.assertTrue(hasher.verify(password_hash, 'cat'))
+            self.assertIsNot(hasher.executor, broken)
+            with mock.patch.object(ProcessPoolExecutor, 'submit', side_effect=BrokenProcessPool):
+                self.assertTrue(hasher.verify(password_hash, 'cat'))
+        finally:
+            hasher.shutdown()
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertTrue(u.avatar(128), ("https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128"))
@@ -59,6 +228,635 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 0)
+
+        u1.follow(u2)
+        db.session.add_all([Post(body='one', author=u1), Post(body='two', author=u1)])
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u1.following_count(), 1)
+        self.assertEqual(u2.followers_count(), 1)
+
+        u1.posts_total = 7
+        u2.followers_total = 0
+        db.session.commit()
+        self.assertEqual(User.repair_counters(1, 3), 2)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u2.followers_count(), 1)
+
+    def test_collection_dict(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(20)]
+        db.session.add_all(users)
+        db.session.commit()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        with self.app.test_request_context():
+            data = User.to_collection_dict(sa.select(User), None, 100, 'api.get_users')
+            expected = db.session.get(User, 20).to_dict()
+        db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(data['items']), 20)
+        self.assertEqual(data['items'][0], expected)
+        self.assertEqual(data['items'][0]['_links']['followers'], '/api/users/20/followers')
+
+    def test_sparse_fieldset(self):
+        self.app.redis = mock.Mock()
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        db.session.expunge_all()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        with self.app.test_request_context():
+            data = User.to_collection_dict(sa.select(User), None, 10, 'api.get_users', fields=['username'], include=[])
+        db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.app.redis.hmget.assert_not_called()
+        self.assertEqual(User.batch_context([], fields=['username'], include=[]), {})
+        self.assertEqual(User.batch_context([], fields=['username']), {})
+        with self.app.test_request_context():
+            self.assertEqual(set(User.batch_context([], fields=['last_seen'], include=['links'])), {'seen', 'urls'})
+        self.assertEqual(data['items'], [{'username': 'susan'}])
+        self.assertIn('fields=username', data['_links']['self'])
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('about_me', statements[0])
+        self.assertNotIn('email', statements[0])
+
+    def test_lookup_dict(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        with self.app.test_request_context():
+            data = User.to_lookup_dict([u2.id, 42, u1.id], fields=['id', 'username'])
+        self.assertEqual(data['items'], {str(u2.id): {'id': u2.id, 'username': 'susan'}, '42': None,
+                                         str(u1.id): {'id': u1.id, 'username': 'john'}})
+        self.assertEqual(data['_meta']['not_found'], [42])
+
+    def test_follow_many(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        p1 = Post(body='post from susan', author=u2)
+        db.session.add(p1)
+        u1.follow(u3)
+        db.session.commit()
+
+        results = u1.follow_many([u2.id, u3.id, u1.id, 42])
+        db.session.commit()
+        self.assertEqual(results, {u2.id: 'followed', u3.id: 'already_following', u1.id: 'self', 42: 'not_found'})
+        self.assertEqual(u1.following_count(), 2)
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u3.followers_count(), 1)
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p1])
+
+        results = u1.unfollow_many([u2.id, u3.id, u1.id, 42])
+        db.session.commit()
+        self.assertEqual(results, {u2.id: 'unfollowed', u3.id: 'unfollowed', u1.id: 'self', 42: 'not_found'})
+        self.assertEqual(u1.following_count(), 0)
+        self.assertEqual(u2.followers_count(), 0)
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [])
+
+        execute = db.session.execute
+        def follow_concurrently(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+            if mocked.call_count == 1:
+                execute(followers.insert().values(follower_id=u1.id, followed_id=u3.id))
+                execute(sa.update(User).where(User.id == u1.id).values(following_total=User.following_total + 1))
+                execute(sa.update(User).where(User.id == u3.id).values(followers_total=User.followers_total + 1))
+            return result
+        dialect = db.session.get_bind().dialect
+        with mock.patch.object(dialect, 'insert_returning', False), \
+                mock.patch.object(db.session, 'execute', side_effect=follow_concurrently) as mocked:
+            results = u1.follow_many([u2.id, u3.id])
+        db.session.commit()
+        self.assertEqual(results, {u2.id: 'followed', u3.id: 'already_following'})
+        self.assertEqual(u1.following_count(), 2)
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u3.followers_count(), 1)
+
+    def test_follow_api(self):
+        self.app.redis = DictRedis()
+        self.app.token_listener = mock.Mock()
+        self.app.token_listener.ensure.return_value = True
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {u1.get_token()}'}
+        db.session.commit()
+        url = f'/api/users/{u1.id}/following'
+        client = self.app.test_client()
+        self.assertEqual(client.post(url, json={'ids': [True]}, headers=headers).status_code, 400)
+        response = client.post(url, json={'ids': [u2.id]}, headers=headers)
+        self.assertEqual(response.get_json(), {'results': {str(u2.id): 'followed'}})
+        self.assertEqual(client.delete(url, headers=headers).status_code, 400)
+        self.assertEqual(client.delete(url, data='{', content_type='application/json', headers=headers).status_code, 400)
+
+    def test_search_bulk_index(self):
+        self.app.search_backend = ElasticsearchBackend(mock.Mock())
+        self.app.config['SEARCH_INDEX_BACKOFF'] = 0
+        calls = []
+        def streaming_bulk(client, operations, **kwargs):
+            calls.append([operation['_id'] for operation in operations])
+            for i, operation in enumerate(operations):
+                yield len(calls) > 1 or i > 0, {operation['_op_type']: {'status': 200 if i else 503}}
+        with mock.patch('app.search.streaming_bulk', streaming_bulk):
+            u = User(username='john', email='john@example.com')
+            p1 = Post(body='first', author=u)
+            p2 = Post(body='second', author=u)
+            db.session.add_all([p1, p2])
+            db.session.flush()
+            p1.body = 'first edited'
+            self.app.task_queue = mock.Mock()
+            db.session.commit()
+            self.assertEqual(calls, [[p1.id, p2.id]])
+            name, failed = self.app.task_queue.enqueue.call_args.args
+            self.assertEqual(name, 'app.tasks.index_documents')
+            self.assertEqual(process_operations(failed), [])
+        self.assertEqual(calls, [[p1.id, p2.id], [p1.id]])
+
+    def test_search_suggest_mapping(self):
+        client = mock.Mock()
+        client.indices.exists.return_value = False
+        client.options.return_value.search.return_value = {'hits': {'hits': [{'_id': '1', '_source': {'body': 'quick'}}]}}
+        backend = ElasticsearchBackend(client)
+        backend.create_index('post-1', ['body'])
+        client.indices.create.assert_called_once_with(index='post-1', mappings={'properties': {
+            'body': {'type': 'text', 'fields': {'suggest': {'type': 'search_as_you_type'}}}}})
+        self.assertEqual(backend.suggest('post', 'qui', 5, fields=['body']), [(1, {'body': 'quick'})])
+        query = client.options.return_value.search.call_args.kwargs['query']
+        self.assertEqual(query['multi_match']['fields'], ['body.suggest', 'body.suggest._2gram', 'body.suggest._3gram'])
+
+    def test_sqlite_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='the lazy dog', author=u)
+        p3 = Post(body='a quick dog and a quick fox', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('quick fox', 1, 10)
+        self.assertEqual(set(posts), {p1, p3})
+        self.assertEqual(total, 2)
+        posts, total = Post.search('dog', 2, 1)
+        self.assertEqual(len(list(posts)), 1)
+        self.assertEqual(total, 2)
+
+        p1.body = 'the slow brown fox'
+        db.session.delete(p3)
+        db.session.commit()
+        posts, total = Post.search('quick', 1, 10)
+        self.assertEqual(total, 0)
+        posts, total = Post.search('"slow" OR', 1, 10)
+        self.assertEqual(list(posts), [p1])
+
+    def test_search_document_by_user_id(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        p = Post(body='posted by id', user_id=u.id)
+        db.session.add(p)
+        db.session.commit()
+        posts, total = Post.search_documents('posted', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(posts[0].author.username, 'john')
+
+    def test_reindex_queries(self):
+        self.app.redis = DictRedis()
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+        db.session.add_all([Post(body=f'post {i}', author=users[i % 3]) for i in range(30)])
+        db.session.commit()
+        db.session.expunge_all()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(Post.reindex(chunk_size=10, workers=1), (30, 0))
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len([statement for statement in statements if statement.startswith('SELECT')]), 1)
+
+    def test_reindex_without_redis(self):
+        self.app.redis = redis.Redis.from_url('redis://localhost:1')
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body=f'post {i}', author=u) for i in range(5)])
+        db.session.commit()
+        self.assertEqual(Post.reindex(chunk_size=2, workers=1), (5, 0))
+        self.assertEqual(Post.search_documents('post', 1, 10)[1], 5)
+
+    def test_reindex_author_posts(self):
+        self.app.task_queue = mock.Mock()
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body=f'post {i}', author=u) for i in range(3)])
+        db.session.commit()
+        u.username = 'johnny'
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            db.session.commit()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertFalse([statement for statement in statements if 'FROM post' in statement])
+        self.app.task_queue.enqueue.assert_called_once_with('app.tasks.reindex_author_posts', u.id)
+        chunks = list(Post.author_operations(u.id, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        for chunk in chunks:
+            process_operations(chunk)
+        posts, total = Post.search_documents('post', 1, 10)
+        self.assertEqual({post.author.username for post in posts}, {'johnny'})
+
+    def test_search_documents(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u, language='en')
+        p2 = Post(body='john went home', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            posts, total = Post.search_documents('fox', 1, 10)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+        self.assertEqual(total, 1)
+        self.assertEqual(posts[0].id, p1.id)
+        self.assertEqual(posts[0].body, 'the quick brown fox')
+        self.assertEqual(posts[0].timestamp, p1.timestamp)
+        self.assertEqual(posts[0].language, 'en')
+        self.assertEqual(posts[0].author.username, 'john')
+        self.assertEqual(posts[0].author.avatar(36), u.avatar(36))
+        self.assertEqual([post.id for post in Post.search_documents('john', 1, 10)[0]], [p2.id])
+
+        u.username = 'johnny'
+        db.session.commit()
+        posts, total = Post.search_documents('fox', 1, 10)
+        self.assertEqual(posts[0].author.username, 'johnny')
+
+        self.app.search_backend.index('post', p1.id, {'body': p1.body})
+        posts, total = Post.search_documents('fox', 1, 10)
+        self.assertEqual(posts, [p1])
+
+    def test_suggest(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='johanna', email='johanna@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        p1 = Post(body='the quick brown fox', author=u1)
+        p2 = Post(body='brownies for everyone', author=u3)
+        db.session.add_all([u1, u2, u3, p1, p2])
+        db.session.commit()
+        self.assertEqual([user.username for user in User.suggest('joh', 5)], ['johanna', 'john'])
+        self.assertEqual([user.username for user in User.suggest('joh', 1)], ['johanna'])
+        self.assertEqual([post.id for post in Post.suggest('Brown', 5)], [p2.id, p1.id])
+        self.assertEqual([post.id for post in Post.suggest('quick bro', 5)], [p1.id])
+        self.assertEqual(Post.suggest('b', 5), [])
+        self.assertEqual(Post.suggest('brown', 5)[0].author.username, 'mary')
+
+    def test_search_cache(self):
+        self.app.redis = DictRedis()
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        db.session.add(p1)
+        db.session.commit()
+        with mock.patch.object(self.app.search_backend, 'search', wraps=self.app.search_backend.search) as search:
+            posts, total = Post.search_documents('fox', 1, 10)
+            self.assertEqual(Post.search_documents('fox', 1, 10)[0][0].body, 'the quick brown fox')
+            self.assertEqual(search.call_count, 1)
+            db.session.add(Post(body='a lazy fox', author=u))
+            db.session.commit()
+            posts, total = Post.search_documents('fox', 1, 10)
+            self.assertEqual(search.call_count, 2)
+            self.assertEqual(total, 2)
+        stats = index_stats()
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']), (1, 2))
+
+    def test_translate_cache(self):
+        calls = []
+        def get(url, params, timeout):
+            calls.append(params)
+            time.sleep(0.05)
+            response = mock.Mock()
+            response.json.return_value = {'responseStatus': 200, 'responseData': {'translatedText': 'привет'}}
+            return response
+        results = []
+        def worker():
+            with self.app.app_context():
+                results.append(translate('hello', 'en', 'ru'))
+        with mock.patch('app.translate.session.get', side_effect=get):
+            threads = [threading.Thread(target=worker) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(translate('hello', 'en', 'ru'), 'привет')
+        self.assertEqual(results, ['привет'] * 8)
+        self.assertEqual(calls, [{'q': 'hello', 'langpair': 'en|ru'}])
+
+        with mock.patch('app.translate.session.get', side_effect=requests.ConnectionError), \
+                self.app.test_request_context():
+            self.assertTrue(translate('bye', 'en', 'ru').startswith('Error'))
+        self.assertIsNone(self.app.translations.get(translation_key('bye', 'en', 'ru')))
+
+    def test_translate_lock(self):
+        self.app.redis = DictRedis()
+        self.app.config.update(TRANSLATE_CONNECT_TIMEOUT=0.05, TRANSLATE_READ_TIMEOUT=0.05)
+        response = mock.Mock()
+        response.json.return_value = {'responseStatus': 200, 'responseData': {'translatedText': 'привет'}}
+        lock = translation_key('hello', 'en', 'ru') + ':lock'
+        self.app.redis.data[lock] = b'other'
+        with mock.patch('app.translate.session.get', return_value=response):
+            self.assertEqual(translate('hello', 'en', 'ru'), 'привет')
+            self.assertEqual(self.app.redis.data[lock], b'other')
+            self.assertEqual(translate('bye', 'en', 'ru'), 'привет')
+        self.assertNotIn(translation_key('bye', 'en', 'ru') + ':lock', self.app.redis.data)
+
+    def test_translate_posts(self):
+        self.app.redis = DictRedis()
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i}', author=u, language='en') for i in range(6)] + [Post(body='пост', author=u, language='ru')]
+        db.session.add_all(posts)
+        db.session.commit()
+        in_flight = []
+        def get(url, params, timeout):
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            time.sleep(0.02)
+            in_flight.pop()
+            response = mock.Mock()
+            response.json.return_value = {'responseStatus': 200, 'responseData': {'translatedText': params['q'].upper()}}
+            return response
+        peak = []
+        with mock.patch('app.translate.session.get', side_effect=get):
+            items = [(post.id, post.body, post.language, 'ru') for post in posts[:6]]
+            self.assertEqual(translate_posts(items, workers=2), [f'POST {i}' for i in range(6)])
+        self.assertEqual(len(peak), 6)
+        self.assertLessEqual(max(peak), 2)
+        self.assertEqual(stored_translations(posts, 'ru'), {post.id: post.body.upper() for post in posts[:6]})
+        self.assertEqual(stored_translations(posts, 'en'), {})
+
+    def test_detect_languages(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='The weather is lovely today and we are going for a long walk', author=u)
+        p2 = Post(body='Сегодня прекрасная погода и мы идём на долгую прогулку', author=u)
+        p3 = Post(body='12345', author=u, language='en')
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertIsNone(p1.language)
+        Post.queue_language_detection([p1.id, p2.id, p3.id])
+        self.assertEqual((p1.language, p2.language, p3.language), ('en', 'ru', 'en'))
+        self.assertEqual(Post.search_documents('weather', 1, 10)[0][0].language, 'en')
+        self.assertEqual(detect_languages(['12345', p2.body] * 2), ['', 'ru', '', 'ru'])
+
+    def test_notification_publish(self):
+        self.app.redis = mock.Mock()
+        publish = self.app.redis.pipeline.return_value.publish
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 3)
+        publish.assert_not_called()
+        db.session.commit()
+        channel, payload = publish.call_args.args
+        self.assertEqual(channel, f'notifications:{u.id}')
+        self.assertEqual(json.loads(payload)['data'], 3)
+        u.add_notification('unread_message_count', 4)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(publish.call_count, 1)
+
+    def test_redis_notification_store(self):
+        self.app.redis = DictRedis()
+        self.app.config['NOTIFICATION_STORE'] = 'redis'
+        self.app.config['NOTIFICATION_HISTORY'] = 3
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        for count in range(5):
+            u.add_notification('unread_message_count', count)
+            db.session.commit()
+        u.add_notification('task_progress', {'task_id': 'x', 'progress': 10})
+        db.session.rollback()
+        u.add_notification('task_progress', {'task_id': 'x', 'progress': 50})
+        db.session.commit()
+        notifications = u.notifications_since(0)
+        self.assertEqual([(n['name'], n['data']) for n in notifications],
+                         [('unread_message_count', 4), ('task_progress', {'task_id': 'x', 'progress': 50})])
+        self.assertEqual(u.notifications_since(notifications[0]['timestamp']), notifications[1:])
+        self.assertEqual([n['data'] for n in notification_history(u.id)],
+                         [{'task_id': 'x', 'progress': 50}, 4, 3])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Notification)), 0)
+
+    def test_task_progress(self):
+        self.app.redis = DictRedis()
+        u = User(username='john', email='john@example.com')
+        task = Task(id='job-1', name='export_posts', description='Exporting posts...', user=u)
+        db.session.add_all([u, task])
+        db.session.commit()
+        self.assertEqual(u.get_task_in_progress('export_posts'), task)
+        self.assertEqual(task.get_progres(), 0)
+        publish_task_progress(u.id, task.id, 40, 60)
+        self.assertEqual(task.get_progres(), 40)
+        self.assertEqual(u.tasks_progress(), [(task, 40)])
+        self.assertEqual([(n['name'], n['data']) for n in u.notifications_since(0)],
+                         [('task_progress', {'task_id': 'job-1', 'progress': 40})])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Notification)), 0)
+        task.complete = True
+        db.session.commit()
+        self.assertIsNone(u.get_task_in_progress('export_posts'))
+        self.assertEqual(u.tasks_progress(), [])
+        self.app.redis = mock.Mock(**{'hmget.side_effect': redis.exceptions.ConnectionError})
+        self.assertEqual(task.get_progres(), 100)
+
+    def test_export_posts(self):
+        tasks = import_tasks()
+        self.app.redis = DictRedis()
+        self.app.task_queue = mock.Mock()
+        self.app.config.update(EXPORT_DIR=tempfile.mkdtemp(), EXPORT_BATCH_SIZE=2, EXPORT_PROGRESS_ROWS=1,
+                               TASK_PROGRESS_INTERVAL=0, ADMINS=['admin@example.com'], SECRET_KEY='secret')
+        self.addCleanup(shutil.rmtree, self.app.config['EXPORT_DIR'])
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', timestamp=now+timedelta(seconds=i), author=u1) for i in range(5)]
+        task = Task(id='job-1', name='export_posts', description='Exporting posts...', user=u1)
+        db.session.add_all([u1, u2, task] + posts)
+        db.session.commit()
+
+        job = mock.Mock(id='job-1', meta={'user_id': u1.id})
+        progress = []
+        job.save_meta.side_effect = lambda: progress.append(job.meta['progress'])
+        with mock.patch.object(tasks, 'app', self.app), mock.patch.object(tasks, 'get_current_job', return_value=job):
+            with mail.record_messages() as outbox:
+                tasks.export_posts(u1.id)
+            self.app.config['EXPORT_ATTACHMENT_MAX'] = 0
+            with mail.record_messages() as large:
+                tasks.export_posts(u1.id)
+
+        self.assertEqual(progress, [0, 20, 40, 60, 80, 99, 100] * 2)
+        self.assertTrue(db.session.get(Task, 'job-1').complete)
+        with gzip.open(u1.export_path(), 'rt', encoding='utf-8') as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual([row['body'] for row in rows], [f'post {i}' for i in range(5)])
+        self.assertEqual(len(outbox[0].attachments), 1)
+        self.assertEqual(outbox[0].attachments[0].filename, 'posts.ndjson.gz')
+        self.assertEqual(large[0].attachments, [])
+        self.assertIn('too large to attach', large[0].body)
+        self.assertEqual(os.listdir(self.app.config['EXPORT_DIR']), [f'{u1.id}.ndjson.gz'])
+
+        self.app.test_client_class = FlaskLoginClient
+        self.assertEqual(self.app.test_client(user=u2).get('/export_posts/download/').status_code, 404)
+        g.pop('_login_user')  # requests share the test's app context, where Flask-Login caches the user
+        response = self.app.test_client(user=u1).get('/export_posts/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertEqual(len(gzip.decompress(response.data).splitlines()), 5)
+        response.close()
+        os.remove(u1.export_path())
+        self.assertEqual(self.app.test_client(user=u1).get('/export_posts/download/').status_code, 404)
+
+    def test_last_seen_buffer(self):
+        self.app.redis = DictRedis()
+        self.app.task_queue = mock.Mock()
+        u = User(username='john', email='john@example.com', last_seen=datetime(2020, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        db.session.refresh(u)
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        for i in range(3):
+            u.record_last_seen()
+        sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+        self.assertEqual(len(self.app.redis.data['last_seen']), 1)
+        self.app.task_queue.enqueue_in.assert_called_once_with(
+            timedelta(seconds=self.app.config['LAST_SEEN_FLUSH_INTERVAL']), 'app.tasks.flush_last_seen')
+        self.assertGreater(u.seen_at(), datetime(2020, 1, 1))
+        with self.app.test_request_context():
+            self.assertEqual(u.to_dict()['last_seen'], User.to_dict_batch([u])[0]['last_seen'])
+
+        buffered = u.seen_at()
+        self.assertEqual(User.flush_last_seen(), 1)
+        self.assertEqual(User.flush_last_seen(), 0)
+        db.session.expire(u)
+        self.assertEqual(u.last_seen, buffered)
+        self.assertEqual(u.seen_at(), buffered)
+
+    def test_last_seen_skipped_endpoints(self):
+        self.app.redis = DictRedis()
+        self.app.task_queue = mock.Mock()
+        self.app.config['SECRET_KEY'] = 'secret'
+        self.app.test_client_class = FlaskLoginClient
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client(user=u)
+        for url in ['/autocomplete?q=jo', '/notifications', '/notifications/stream']:
+            client.get(url).close()
+        self.assertNotIn('last_seen', self.app.redis.data)
+        self.assertEqual(client.get('/index/').status_code, 200)
+        self.assertIn(str(u.id).encode(), self.app.redis.data['last_seen'])
+
+    def test_token_cache(self):
+        self.app.redis = DictRedis()
+        self.app.token_listener = mock.Mock()
+        self.app.token_listener.ensure.return_value = True
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+        user_id = u.id
+        db.session.expunge_all()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        user = User.check_token(token)
+        self.assertEqual(user.id, user_id)
+        self.assertEqual(statements, [])
+        self.app.token_cache.clear()
+        self.assertEqual(User.check_token(token).id, user_id)
+        self.assertEqual(statements, [])
+        sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(user.username, 'john')
+
+        self.app.redis = DictRedis()
+        self.app.token_cache.clear()
+        self.assertEqual(User.check_token(token).id, user_id)
+        self.assertIsNotNone(self.app.redis.get(f'token:{User.token_key(token)}'))
+        self.assertIsNotNone(self.app.token_cache.get(User.token_key(token)))
+
+        self.app.redis = DictRedis()
+        self.app.token_cache.clear()
+        stale = User(id=user_id, username='john', token=token, token_expiration=user.token_expiration)
+        def revoke_after_read(query):
+            user.revoke_token()
+            db.session.commit()
+            return stale
+        with mock.patch.object(db.session, 'scalar', side_effect=revoke_after_read):
+            self.assertEqual(User.check_token(token), stale)
+        self.assertEqual(self.app.redis.get(f'token:{User.token_key(token)}'), b'revoked')
+        self.assertIsNone(self.app.token_cache.get(User.token_key(token)))
+        self.assertIsNone(User.check_token(token))
+        self.assertIsNone(User.check_token('0' * 32))
+
+    def test_identity_cache(self):
+        self.app.redis = DictRedis()
+        cache = self.app.identity_cache
+        cache.listener = mock.Mock()
+        cache.listener.ensure.return_value = True
+        u = User(username='john', email='john@example.com', about_me='hi')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        self.assertEqual(User.by_username('john').id, user_id)
+        db.session.expunge_all()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', listener)
+        user = User.by_username('john')
+        self.assertEqual((user.id, user.username, user.about_me), (user_id, 'john', 'hi'))
+        db.session.expunge_all()
+        cache.local.clear()
+        self.assertEqual(User.load_user(str(user_id)).email, 'john@example.com')
+        sa.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+
+        user = User.load_user(str(user_id))
+        user.username = 'johnny'
+        db.session.commit()
+        self.assertIsNone(User.by_username('john'))
+        self.assertEqual(User.by_username('johnny').id, user_id)
+        self.assertEqual(User.load_user(str(user_id)).username, 'johnny')
+        self.assertEqual(cache.stats()['redis_hits'], 1)
+        cache.report(force=True)
+        self.assertEqual(self.app.redis.hgetall('identity:stats')[b'redis_hits'], b'1')
+
+    def test_notification_stream(self):
+        pubsub = mock.Mock()
+        messages = [
+            None,
+            {'data': json.dumps({'name': 'n', 'data': 1, 'timestamp': 5.0})},
+            {'data': json.dumps({'name': 'n', 'data': 2, 'timestamp': 7.0})}
+        ]
+        pubsub.get_message.side_effect = lambda **kwargs: messages.pop(0) if messages else None
+        stream = event_stream(pubsub, [{'name': 'n', 'data': 0, 'timestamp': 6.0}], 1.0, 0, 0.05, 3000)
+        events = list(stream)
+        self.assertEqual(events[0], 'retry: 3000\n\n')
+        self.assertEqual([json.loads(event.split('data: ')[1]) for event in events if 'data: ' in event],
+                         [{'name': 'n', 'data': 0, 'timestamp': 6.0}, {'name': 'n', 'data': 2, 'timestamp': 7.0}])
+        self.assertIn(': heartbeat\n\n', events)
+        pubsub.close.assert_called_once()
+
     def test_follow_posts(self):
         u1 = User(username="john", email="john@mail.com")
         u2 = User(username="anton", email="anton@mail.com")
@@ -91,6 +889,155 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p4, p3])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username="john", email="john@mail.com")
+        u2 = User(username="anton", email="anton@mail.com")
+        u3 = User(username="mary", email="mary@mail.com")
+        db.session.add_all([u1, u2, u3])
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", timestamp=now+timedelta(seconds=1), author=u1)
+        p2 = Post(body="post from anton", timestamp=now+timedelta(seconds=2), author=u2)
+        p3 = Post(body="post from mary", timestamp=now+timedelta(seconds=3), author=u3)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p3, p2, p1])
+        self.assertEqual(db.session.scalars(u2.timeline_posts()).all(), [p2])
+
+        p4 = Post(body="new post from anton", timestamp=now+timedelta(seconds=4), author=u2)
+        db.session.add(p4)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p4, p3, p2, p1])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p3, p1])
+
+        u1.rebuild_timeline()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), db.session.scalars(u1.following_posts()).all())
+
+    def test_timeline_length(self):
+        self.app.config['TIMELINE_LENGTH'] = 5
+        self.app.config['TIMELINE_TRIM_PROBABILITY'] = 0
+        u1 = User(username="john", email="john@mail.com")
+        u2 = User(username="anton", email="anton@mail.com")
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        posts = []
+        for i in range(20):
+            posts.append(Post(body=f"post {i}", timestamp=now+timedelta(seconds=i), author=u2))
+            db.session.add(posts[-1])
+            db.session.commit()
+        newest = posts[:-6:-1]
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), newest)
+        self.assertEqual(db.session.scalars(u2.timeline_posts()).all(), newest)
+        stored = sa.select(sa.func.count()).select_from(timeline).where(timeline.c.user_id == u1.id)
+        self.assertEqual(db.session.scalar(stored), 20)
+
+        self.app.config['TIMELINE_TRIM_PROBABILITY'] = 1
+        posts.append(Post(body="post 20", timestamp=now+timedelta(seconds=20), author=u2))
+        db.session.add(posts[-1])
+        db.session.commit()
+        self.assertEqual(db.session.scalar(stored), 5)
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), posts[:-6:-1])
+
+    def test_timeline_pulled_authors(self):
+        self.app.config['TIMELINE_PULL_THRESHOLD'] = 2
+        u1 = User(username="john", email="john@mail.com")
+        u2 = User(username="anton", email="anton@mail.com")
+        u3 = User(username="mary", email="mary@mail.com")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.pulled_authors(), [u3])
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", timestamp=now+timedelta(seconds=1), author=u1)
+        p2 = Post(body="post from mary", timestamp=now+timedelta(seconds=2), author=u3)
+        p3 = Post(body="post from anton", timestamp=now+timedelta(seconds=3), author=u2)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p1])
+
+        page = u1.timeline(None, 1)
+        self.assertEqual(page.items, [p2])
+        self.assertTrue(page.has_next)
+        page = u1.timeline(page.next_cursor, 1)
+        self.assertEqual(page.items, [p1])
+        self.assertFalse(page.has_next)
+        page = u1.timeline(page.prev_cursor, 1)
+        self.assertEqual(page.items, [p2])
+        self.assertFalse(page.has_prev)
+        self.assertEqual(u2.timeline(None, 10).items, [p3, p2, p1])
+
+    def test_timeline_demoted_author(self):
+        self.app.config['TIMELINE_PULL_THRESHOLD'] = 2
+        u1 = User(username="john", email="john@mail.com")
+        u2 = User(username="anton", email="anton@mail.com")
+        u3 = User(username="mary", email="mary@mail.com")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from mary", timestamp=now+timedelta(seconds=1), author=u3)
+        p2 = Post(body="another post from mary", timestamp=now+timedelta(seconds=2), author=u3)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [])
+
+        u2.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.pulled_authors(), [])
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p2, p1])
+        self.assertEqual(u1.timeline(None, 10).items, [p2, p1])
+        self.assertEqual(db.session.scalars(u2.timeline_posts()).all(), [])
+
+        u2.follow(u3)
+        u1.unfollow_many([u3.id])
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u2.timeline_posts()).all(), [p2, p1])
+
+    def test_keyset_pagination(self):
+        u = User(username="john", email="john@mail.com")
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f"post {i}", timestamp=now+timedelta(seconds=i // 2), author=u) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        page = paginate(sa.select(Post), [Post.timestamp, Post.id], per_page=2, count=True)
+        self.assertEqual(page.items, expected[:2])
+        self.assertEqual(page.total, 5)
+        self.assertFalse(page.has_prev)
+        page = paginate(sa.select(Post), [Post.timestamp, Post.id], cursor=page.next_cursor, per_page=2)
+        self.assertEqual(page.items, expected[2:4])
+        self.assertIsNone(page.total)
+        page = paginate(sa.select(Post), [Post.timestamp, Post.id], cursor=page.next_cursor, per_page=2)
+        self.assertEqual(page.items, expected[4:])
+        self.assertFalse(page.has_next)
+        page = paginate(sa.select(Post), [Post.timestamp, Post.id], cursor=page.prev_cursor, per_page=2)
+        self.assertEqual(page.items, expected[2:4])
+        self.assertTrue(page.has_prev)
+
+        for cursor in [page.next_cursor, encode_cursor('next', ['x']), encode_cursor('next', [True])]:
+            with self.assertRaises(BadRequest):
+                paginate(sa.select(User), [User.id], cursor=cursor)
+        with self.assertRaises(BadRequest):
+            paginate(sa.select(Post), [Post.timestamp, Post.id], cursor=encode_cursor('next', ['x', 1]))
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)